@@ -6,6 +6,7 @@ Created on 2022-09-30.
 import h5py
 import io
 import os
+import json
 import numpy as np
 import xarray as xr
 # from time import time
@@ -40,12 +41,20 @@ class H5(object):
         The input data need to be a path to HDF5 file(s), BytesIO objects, bytes objects, or xr.Datasets (or some combo of those).
     group : str or None
         The group or group path within the hdf5 file(s) to the datasets.
+    lazy : bool
+        Should only the metadata (dtypes, encodings, and attrs) be read on initialisation? The coordinate data are then read and combined the first time they are needed (e.g. by sel, coords, or to_hdf5).
+    cache : str, pathlib.Path, or None
+        A path to a cache file (python shelve) for the scanned metadata and coordinates of the input files. Files are identified by their path, modification time, and size, so only new or modified files will be opened and scanned. Only inputs that are file paths are cached.
+    n_workers : int or None
+        The number of processes used to scan the input files (when they are read). Each file is opened once in a worker and everything needed is extracted in a single pass. Only inputs that are file paths are scanned in parallel. None or 1 scans the files serially in the current process.
+    access_profile : dict or None
+        The h5py.File keyword arguments used to open the HDF5 inputs (e.g. rdcc_nbytes, rdcc_nslots, rdcc_w0, or page_buf_size). It doesn't apply to inputs that are already open h5py.Files or xr.Datasets. None uses the h5py defaults.
 
     Returns
     -------
     H5 instance
     """
-    def __init__(self, data: Union[List[Union[str, pathlib.Path, io.BytesIO, xr.Dataset]], Union[str, pathlib.Path, io.BytesIO, xr.Dataset]], group=None):
+    def __init__(self, data: Union[List[Union[str, pathlib.Path, io.BytesIO, xr.Dataset]], Union[str, pathlib.Path, io.BytesIO, xr.Dataset]], group=None, lazy=False, cache: Union[str, pathlib.Path] = None, n_workers: int=None, access_profile: dict=None):
         """
         Class to load and combine one or more HDF5 data files (or xarray datasets) with optional filters. The class will then export the combined data to an HDF5 file, file object, or xr.Dataset.
 
@@ -55,6 +64,14 @@ class H5(object):
             The input data need to be a path to HDF5 file(s), BytesIO objects, bytes objects, or xr.Datasets (or some combo of those).
         group : str or None
             The group or group path within the hdf5 file(s) to the datasets.
+        lazy : bool
+            Should only the metadata (dtypes, encodings, and attrs) be read on initialisation? The coordinate data are then read and combined the first time they are needed (e.g. by sel, coords, or to_hdf5).
+        cache : str, pathlib.Path, or None
+            A path to a cache file (python shelve) for the scanned metadata and coordinates of the input files. Files are identified by their path, modification time, and size, so only new or modified files will be opened and scanned. Only inputs that are file paths are cached.
+        n_workers : int or None
+            The number of processes used to scan the input files (when they are read). Each file is opened once in a worker and everything needed is extracted in a single pass. Only inputs that are file paths are scanned in parallel. None or 1 scans the files serially in the current process.
+        access_profile : dict or None
+            The h5py.File keyword arguments used to open the HDF5 inputs (e.g. rdcc_nbytes, rdcc_nslots, rdcc_w0, or page_buf_size). It doesn't apply to inputs that are already open h5py.Files or xr.Datasets. None uses the h5py defaults.
 
         Returns
         -------
@@ -66,26 +83,32 @@ class H5(object):
         else:
             data1 = [data]
 
-        files = utils.open_files(data1, group)
+        ## Scan the files
+        manifests = utils.scan_files(data1, group, not lazy, cache, n_workers, access_profile)
 
         ## Get encodings
-        encodings = utils.get_encodings(files)
+        encodings = utils.combine_encodings(manifests)
 
         ## Get attrs
-        attrs, global_attrs = utils.get_attrs(files)
+        attrs, global_attrs = utils.combine_attrs(manifests)
 
-        ## Get the extended coords
-        coords_dict = utils.extend_coords(files, encodings)
-
-        ## Add the variables as datasets
-        vars_dict = utils.index_variables(files, coords_dict, encodings)
+        if lazy:
+            coords_dict = None
+            vars_dict = None
+        else:
+            ## Get the extended coords
+            coords_dict = utils.extend_coords(manifests)
 
-        ## Close files
-        utils.close_files(files)
+            ## Add the variables as datasets
+            vars_dict = utils.index_variables(manifests, coords_dict, encodings)
 
         ## Assign attributes
         self._files = data1
         self._group = group
+        self._cache = cache
+        self._n_workers = n_workers
+        self._access_profile = access_profile
+        self._manifests = manifests
         self._coords_dict = coords_dict
         self._data_vars_dict = vars_dict
         self._attrs = attrs
@@ -93,10 +116,66 @@ class H5(object):
         self._encodings = encodings
 
 
+    def _load_index(self):
+        """
+        Read and combine the coordinates and index the data variables if they haven't been loaded yet (i.e. lazy=True).
+        """
+        if self._coords_dict is None:
+            scan_index = [i for i, manifest in enumerate(self._manifests) if any(data is None for data in manifest['coords'].values())]
+            manifests = utils.scan_files([self._files[i] for i in scan_index], self._group, True, self._cache, self._n_workers, self._access_profile)
+            self._manifests = list(self._manifests)
+            for i, manifest in zip(scan_index, manifests):
+                self._manifests[i] = manifest
+
+            coords_dict = utils.extend_coords(self._manifests)
+            vars_dict = utils.index_variables(self._manifests, coords_dict, self._encodings)
+
+            self._coords_dict = coords_dict
+            self._data_vars_dict = vars_dict
+
+
+    def append(self, data: Union[List[Union[str, pathlib.Path, io.BytesIO, xr.Dataset]], Union[str, pathlib.Path, io.BytesIO, xr.Dataset]]):
+        """
+        Add more input data to the H5 instance (in place). Only the new inputs are scanned and indexed, and their coordinates are combined with the existing coordinates.
+
+        Parameters
+        ----------
+        data : str, pathlib.Path, io.BytesIO, xr.Dataset, or list of str, pathlib.Path, io.BytesIO, bytes, or xr.Dataset
+            The input data need to be a path to HDF5 file(s), BytesIO objects, bytes objects, or xr.Datasets (or some combo of those).
+
+        Returns
+        -------
+        None
+        """
+        if isinstance(data, list):
+            data1 = data
+        else:
+            data1 = [data]
+
+        start = len(self._files)
+        lazy = self._coords_dict is None
+
+        manifests = utils.scan_files(data1, self._group, not lazy, self._cache, self._n_workers, self._access_profile)
+
+        encodings = utils.combine_encodings(manifests, self._encodings)
+        attrs, global_attrs = utils.combine_attrs(manifests, self._attrs, self._global_attrs)
+
+        if not lazy:
+            utils.extend_index(self._coords_dict, self._data_vars_dict, manifests, encodings, start)
+
+        self._files = self._files + data1
+        self._manifests = self._manifests + manifests
+        self._attrs = attrs
+        self._global_attrs = global_attrs
+        self._encodings = encodings
+
+
     def _build_empty_ds(self):
         """
 
         """
+        self._load_index()
+
         if self._data_vars_dict:
 
             ## get all of the coords associated with the existing data vars
@@ -142,14 +221,14 @@ class H5(object):
         return xr_ds.__repr__()
 
 
-    def sel(self, selection: dict=None, include_coords: list=None, exclude_coords: list=None, include_data_vars: list=None, exclude_data_vars: list=None):
+    def sel(self, selection: dict=None, include_coords: list=None, exclude_coords: list=None, include_data_vars: list=None, exclude_data_vars: list=None, method: str=None, tolerance=None):
         """
         Filter the data by a selection, include, and exclude. Returns a new H5 instance. The selection parameter is very similar to xarry's .sel method.
 
         Parameters
         ----------
         selection : dict
-            This filter requires a dict of coordinates using three optional types of filter values. These include slice instances (the best and preferred option), a list/np.ndarray of coordinate values, or a bool np.ndarray of the coordinate data length.
+            This filter requires a dict of coordinates using four optional types of filter values. These include slice instances (the best and preferred option), a list of slice instances (e.g. many disjoint time windows), a list/np.ndarray of coordinate values, or a bool np.ndarray of the coordinate data length.
         include_coords : list
             A list of coordinates to include in the output. Only data variables with included coordinates will be included in the output.
         exclude_coords : list
@@ -158,21 +237,22 @@ class H5(object):
             A list of data variables to include in the output. Only coordinates that have data variables will be included in the output.
         exclude_data_vars : list
             A list of data variables to exclude from the output. Only coordinates that have data variables will be included in the output.
+        method : str or None
+            How a list/np.ndarray of coordinate values in the selection is matched. None selects only the exact values and 'nearest' selects the nearest coordinate value to each of the values.
+        tolerance : int, float, np.timedelta64, or None
+            The maximum distance between a value and its nearest coordinate value when method='nearest'. Values without a coordinate value within the tolerance are not selected. For datetime coordinates, it can be a np.timedelta64 or a number of seconds. None has no limit.
 
         Returns
         -------
         H5 instance
         """
+        self._load_index()
+
         c = self.copy()
         if selection is not None:
-            files = utils.open_files(self._files, self._group)
-            utils.filter_coords(files, c._coords_dict, selection, self._encodings)
-            vars_dict = utils.index_variables(files, c._coords_dict, c._encodings)
-
-            c._data_vars_dict = vars_dict
-
-            ## Close files
-            utils.close_files(files)
+            utils.filter_coords(c._coords_dict, selection, c._encodings, method, tolerance)
+            pruned = utils.prune_files(c._manifests, c._coords_dict)
+            c._data_vars_dict = utils.index_variables(c._manifests, c._coords_dict, c._encodings, pruned=pruned)
 
         if include_coords is not None:
             coords_rem_list = []
@@ -229,9 +309,19 @@ class H5(object):
 
     def copy(self):
         """
-        Deep copy an H5 instance.
+        Copy an H5 instance. The input files, the (read only) coordinate arrays, and the per-file indexes are shared with the copy and only the containers that sel or append could modify are copied.
         """
-        c = copy.deepcopy(self)
+        c = copy.copy(self)
+
+        c._files = list(self._files)
+        c._manifests = list(self._manifests)
+        c._attrs = {k: dict(v) for k, v in self._attrs.items()}
+        c._global_attrs = dict(self._global_attrs)
+        c._encodings = {k: dict(v) for k, v in self._encodings.items()}
+
+        if self._coords_dict is not None:
+            c._coords_dict = dict(self._coords_dict)
+            c._data_vars_dict = utils.copy_vars_dict(self._data_vars_dict)
 
         return c
 
@@ -240,6 +330,8 @@ class H5(object):
         """
         A Summary of the coordinates.
         """
+        self._load_index()
+
         coords_summ = {}
         for k, v in self._coords_dict.items():
             encs = copy.deepcopy(self._encodings[k])
@@ -253,6 +345,8 @@ class H5(object):
         """
         A summary of the data variables.
         """
+        self._load_index()
+
         vars_summ = {}
         for k, v in self._data_vars_dict.items():
             encs = copy.deepcopy(self._encodings[k])
@@ -274,7 +368,56 @@ class H5(object):
         return coords_summ
 
 
-    def to_hdf5(self, output: Union[str, pathlib.Path, io.BytesIO], group=None, chunks=None, unlimited_dims=None, compression='zstd'):
+    def iter_chunks(self, var_name: str, chunks: tuple=None):
+        """
+        Generator that reads a data variable block by block straight from the input files. Only one block is held in memory at a time.
+
+        Parameters
+        ----------
+        var_name : str
+            The name of the data variable.
+        chunks : tuple of int or None
+            The maximum shape of the blocks in the dims order of the data variable. None will use the auto-chunking shape.
+
+        Returns
+        -------
+        Generator of tuples of (global_slice, np.ndarray)
+            The global_slice is a tuple of slices of the position of the (decoded) data block in the combined data variable. The blocks are yielded file by file, so if input files overlap then the blocks of later files should take precedence (as in to_hdf5).
+        """
+        self._load_index()
+
+        if var_name not in self._data_vars_dict:
+            raise ValueError(var_name + ' is not one of the data variables.')
+
+        var_dict = self._data_vars_dict[var_name]
+        encoding = self._encodings[var_name]
+
+        files = utils.open_files(self._files, self._group, self._access_profile)
+
+        try:
+            if len(var_dict['shape']) == 0:
+                for i in var_dict['data']:
+                    ds_old = files[i][var_name]
+
+                    if isinstance(ds_old, xr.DataArray):
+                        data = utils.encode_data(ds_old.values, **encoding)
+                    else:
+                        data = ds_old[()]
+
+                    yield (), utils.decode_data(np.asarray(data), **encoding)
+            else:
+                if chunks is None:
+                    chunks = utils.guess_chunk(var_dict['shape'], var_dict['shape'], var_dict['dtype'])
+
+                for global_chunk, ds_old, local_chunk, transpose_order, direct in utils.index_var_chunks(files, var_name, var_dict, chunks, factor=1):
+                    data = utils.read_chunk(ds_old, local_chunk, transpose_order, encoding)
+
+                    yield global_chunk, utils.decode_data(data, **encoding)
+        finally:
+            utils.close_files(files)
+
+
+    def to_hdf5(self, output: Union[str, pathlib.Path, io.BytesIO], group=None, chunks=None, unlimited_dims=None, compression='zstd', n_workers=None, mode='w', access_profile=None, codecs=None, strings=None, chunk_strategy=None):
         """
         Method to output the filtered data to an HDF5 file or file object.
 
@@ -285,160 +428,427 @@ class H5(object):
         group : str or None
             The group or group path within the hdf5 file to save the datasets.
         chunks : dict of tuples
-            The chunks per dataset. Must be a dictionary of dataset names with tuple values of appropriate dimensions. A value of None will perform auto-chunking.
+            The chunks per dataset. Must be a dictionary of dataset names with tuple values of appropriate dimensions. A value of None will perform auto-chunking (see chunk_strategy).
         unlimited_dims : str, list of str, or None
             The dimensions/coordinates that should be assigned as "unlimited" in the hdf5 file.
         compression : str
             The compression used for the chunks in the hdf5 files. Must be one of gzip, lzf, zstd, or None. gzip is compatible with any hdf5 installation (not only h5py), so this should be used if interoperability across platforms is important. lzf is compatible with any h5py installation, so if only python users will need to access these files then this is a better option than gzip. zstd requires the hdf5plugin python package, but is the best compression option if users have access to the hdf5plugin package. None has no compression and is generally not recommended except in niche situations.
+        n_workers : int or None
+            The number of workers used to read, encode, and compress the blocks of chunks of the new data variables. The workers are processes if all of the inputs are file paths (as HDF5 only runs one call at a time per process) and threads otherwise. The compressed chunks are still written to the output by a single thread in the same order as the serial path, so the output is identical. None or 1 runs everything in the calling thread.
+        mode : str
+            Either 'w' to create a new file (overwriting an existing file) or 'a' to append/update an existing file that was created by to_hdf5. In 'a' mode the coordinate values are merged with the existing coordinates and only the chunks touched by the data are written. New coordinate values must come after the existing values and can only be added to unlimited dimensions. The chunks, unlimited_dims, and compression parameters only apply to datasets that don't exist in the file yet.
+        access_profile : str, dict, or None
+            How the HDF5 chunk caches are set up. 'auto' sizes the chunk cache of every output dataset and every (chunked) HDF5 input dataset from the chunk plan, so that all of the chunks overlapped by a block are cached while it is read or written (this avoids chunk cache thrashing when a block spans many chunks, e.g. wide outputs). A dict is passed as h5py.File keyword arguments for the output file (e.g. rdcc_nbytes, rdcc_nslots, rdcc_w0, page_buf_size, or meta_block_size). None uses a 3 MB chunk cache for the output file.
+        codecs : dict or None
+            Codecs to chain onto the stored data of datasets as a dict of dataset names with lists of codecs, e.g. {'temp': [{'id': 'bitround', 'keepbits': 10}], 'time': ['delta']}. These replace the codecs of the input encodings. A codec is either a registered codec name or a dict with the name as 'id' and the codec parameters. The codecs are recorded as JSON in the codecs attr of the datasets and they are undone when the files are read. The built-in codecs are 'bitround' (lossy rounding of the mantissas of float data to keepbits bits, which compresses much better) and 'delta' (differences of integer coordinates). More can be added with utils.register_codec. Float data variables that are scaled to ints in the inputs are stored as floats (without the scale_factor, add_offset, and missing_value) when their codecs only support floats (e.g. bitround). Datasets that already exist in 'a' mode keep their codecs and dtype.
+        strings : str, dict, or None
+            How the string coordinates are stored. 'vlen' stores variable length strings (which can't be compressed by the HDF5 filters). 'fixed' stores fixed width utf-8 bytes (with an _Encoding attr, so that xarray decodes them). 'categorical' stores integer codes with the sorted unique strings as a lookup table in the categories attr, which is best for low cardinality coordinates (e.g. station IDs). A dict of coordinate names with one of these sets the storage per coordinate. None keeps the storage of the input encodings (vlen by default). Coordinates that already exist in 'a' mode keep their storage.
+        chunk_strategy : str, dict, int, or None
+            How the chunks of the data variables are guessed when they are not passed in chunks. 'timeseries' keeps the time dims (datetime coordinates) as long as possible in the chunks, which is best for reading long time series of a few stations. 'spatial' keeps the other dims as whole as possible, which is best for reading a few time steps of all stations. 'balanced' halves the longest chunk axis until the chunks are small enough. A dict of dims with weights makes the chunk lengths roughly proportional to the weights (missing dims get a weight of 1). An int is the target chunk size in bytes (3 MB by default) with the default chunking. None is the default chunking.
 
         Returns
         -------
         None
         """
+        self._load_index()
+
         ## Check if there's anything to save
         if self._coords_dict:
 
             ## Set up initial parameters
             if isinstance(unlimited_dims, str):
                 unlimited_dims = [unlimited_dims]
-            else:
+            elif not isinstance(unlimited_dims, (list, tuple)):
                 unlimited_dims = []
 
+            if mode not in ('w', 'a'):
+                raise ValueError("mode must be either 'w' or 'a'.")
+
             compressor = utils.get_compressor(compression)
 
-            files = utils.open_files(self._files, self._group)
+            ## Check the chunk strategy
+            time_dims = [coord for coord in self._coords_dict if 'calendar' in self._encodings[coord]]
+            utils.chunk_weights((), chunk_strategy)
+            if isinstance(chunk_strategy, (int, np.integer)):
+                target_size = chunk_strategy
+            else:
+                target_size = None
+
+            ## The encodings of the output with the new codecs
+            encodings = {ds_name: enc.copy() for ds_name, enc in self._encodings.items()}
+            float_vars = set()
+            if isinstance(codecs, dict):
+                for ds_name, codecs1 in codecs.items():
+                    if ds_name not in encodings:
+                        raise ValueError(ds_name + ' is not one of the coordinates or data variables.')
+                    codecs1 = utils.parse_codecs(codecs1)
+                    try:
+                        utils.check_codecs(codecs1, encodings[ds_name]['dtype'], ds_name in self._coords_dict)
+                    except TypeError:
+                        # Float data variables that are scaled to ints in the inputs are stored as floats for codecs that need floats
+                        if (ds_name not in self._data_vars_dict) or ('scale_factor' not in encodings[ds_name]) or (np.dtype(encodings[ds_name]['dtype_decoded']).kind != 'f'):
+                            raise
+                        utils.check_codecs(codecs1, encodings[ds_name]['dtype_decoded'])
+                        encodings[ds_name] = utils.float_encoding(encodings[ds_name])
+                        float_vars.add(ds_name)
+                    if codecs1:
+                        encodings[ds_name]['codecs'] = codecs1
+                    else:
+                        encodings[ds_name].pop('codecs', None)
+            elif codecs is not None:
+                raise TypeError('codecs must be a dict of dataset names with lists of codecs.')
+
+            string_coords = [coord for coord in self._coords_dict if encodings[coord]['dtype'] == h5py.string_dtype()]
+            if isinstance(strings, str) or (strings is None):
+                strings = {coord: strings for coord in string_coords}
+            elif isinstance(strings, dict):
+                for coord in strings:
+                    if coord not in string_coords:
+                        raise ValueError(coord + ' is not one of the string coordinates.')
+            else:
+                raise TypeError('strings must be a str, a dict of coordinate names with str values, or None.')
+
+            # String data variables are always stored as variable length strings
+            for ds_name, enc in encodings.items():
+                if ds_name not in string_coords:
+                    for f in ('_Encoding', 'categories'):
+                        enc.pop(f, None)
+
+            files = utils.open_files(self._files, self._group, self._access_profile)
+            executor, encode_block = utils.block_executor(self._files, self._group, files, n_workers, self._access_profile)
+
+            # The workers and the input files are released whatever happens to the output
+            try:
+                ## Create new file or open the existing file
+                file_kwargs = {'rdcc_nbytes': 3*1024*1024}
+                if isinstance(access_profile, dict):
+                    file_kwargs.update(access_profile)
+                elif access_profile not in (None, 'auto'):
+                    raise ValueError("access_profile must be either None, 'auto', or a dict of h5py.File keyword arguments.")
+
+                if mode == 'w':
+                    nf = utils.create_file(output, **file_kwargs)
+                else:
+                    nf = h5py.File(output, mode, libver='latest', **file_kwargs)
 
-            ## Create new file
-            with h5py.File(output, 'w', libver='latest', rdcc_nbytes=3*1024*1024) as nf:
+                with nf:
 
-                if isinstance(group, str):
-                    nf1 = nf.create_group(group)
-                else:
-                    nf1 = nf
+                    if isinstance(group, str):
+                        nf1 = nf.require_group(group)
+                    else:
+                        nf1 = nf
+
+                    ## Existing datasets keep their codecs and dtype
+                    for ds_name in encodings:
+                        if ds_name in nf1:
+                            enc = self._encodings[ds_name].copy()
+                            if (ds_name in self._data_vars_dict) and ('scale_factor' in enc) and (nf1[ds_name].dtype.kind == 'f'):
+                                enc = utils.float_encoding(enc)
+                                float_vars.add(ds_name)
+                            else:
+                                float_vars.discard(ds_name)
+                            encodings[ds_name] = enc
 
-                ## Add the coords as datasets
-                for coord, arr in self._coords_dict.items():
-                    # if coord == 'time':
-                    #     break
-                    shape = arr.shape
-                    dtype = self._encodings[coord]['dtype']
+                            if 'codecs' in nf1[ds_name].attrs:
+                                enc['codecs'] = utils.parse_codecs(nf1[ds_name].attrs['codecs'])
+                            else:
+                                enc.pop('codecs', None)
+
+                            for f in ('_Encoding', 'categories'):
+                                enc.pop(f, None)
+
+                    ## Check the data against the existing datasets before anything in the file is changed
+                    coord_plans = {}
+                    for coord, arr in self._coords_dict.items():
+                        if coord in nf1:
+                            coord_plans[coord] = utils.plan_append_coord(nf1[coord], arr)
+
+                    for ds_name, ds in nf1.items():
+                        if (not isinstance(ds, h5py.Dataset)) or (ds.attrs.get('CLASS') == b'DIMENSION_SCALE') or (len(ds.shape) == 0):
+                            continue
+
+                        ds_dims = tuple(dim.label for dim in ds.dims)
+                        if (ds_name in self._data_vars_dict) and (ds_dims != self._data_vars_dict[ds_name]['dims']):
+                            raise ValueError('The dims of the existing dataset ' + ds_name + ' are not the same as the dims of the new data.')
+
+                        shape = tuple(len(coord_plans[dim]['data']) if dim in coord_plans else nf1[dim].shape[0] for dim in ds_dims)
+                        if any((m is not None) and (s > m) for s, m in zip(shape, ds.maxshape)):
+                            raise ValueError('The existing dataset ' + ds_name + ' can not be resized to the new coordinates.')
+
+                    ## Add the coords as datasets
+                    pos_maps = {}
+                    for coord, arr in self._coords_dict.items():
+                        # if coord == 'time':
+                        #     break
+                        if coord in nf1:
+                            pos_maps[coord] = utils.append_coord(nf1[coord], coord_plans[coord])
+                            continue
+
+                        if coord in string_coords:
+                            storage = strings.get(coord)
+                            if storage is None:
+                                storage = utils.string_storage(encodings[coord])
+                            for f in ('_Encoding', 'categories'):
+                                encodings[coord].pop(f, None)
+                            encodings[coord].update(utils.string_storage_encoding(arr, storage))
+                            arr = utils.encode_strings(arr, encodings[coord])
+
+                        shape = arr.shape
+                        dtype = encodings[coord]['dtype']
+
+                        maxshape = tuple([s if coord not in unlimited_dims else None for s in shape])
+
+                        chunks1 = utils.guess_chunk(shape, maxshape, dtype)
+
+                        if isinstance(chunks, dict):
+                            if coord in chunks:
+                                chunks1 = chunks[coord]
+
+                        ds = nf1.create_dataset(coord, shape, chunks=chunks1, maxshape=maxshape, dtype=dtype, **compressor)
+
+                        if 'codecs' in encodings[coord]:
+                            ds[:] = utils.encode_codecs(arr, encodings[coord]['codecs'])
+                        else:
+                            ds[:] = arr
 
-                    maxshape = tuple([s if s not in unlimited_dims else None for s in shape])
+                        ds.make_scale(coord)
 
-                    chunks1 = utils.guess_chunk(shape, maxshape, dtype)
+                    ## Add the variables as datasets
+                    vars_dict = utils.copy_vars_dict(self._data_vars_dict)
+                    for var_name in float_vars:
+                        vars_dict[var_name].update(dtype=encodings[var_name]['dtype'], fillvalue=np.nan)
 
-                    if isinstance(chunks, dict):
-                        if coord in chunks:
-                            chunks1 = chunks[coord]
+                    for var_name in vars_dict:
+                        dims = vars_dict[var_name]['dims']
 
-                    ds = nf1.create_dataset(coord, shape, chunks=chunks1, maxshape=maxshape, dtype=dtype, **compressor)
+                        ## Map the global index to the positions in the existing coords
+                        for axis, dim in enumerate(dims):
+                            if dim in pos_maps:
+                                utils.remap_var_index(vars_dict[var_name], axis, pos_maps[dim])
 
-                    ds[:] = arr
+                        shape = tuple(nf1[dim].shape[0] for dim in dims)
+                        vars_dict[var_name]['shape'] = shape
 
-                    ds.make_scale(coord)
+                        new_ds = var_name not in nf1
 
-                ## Add the variables as datasets
-                vars_dict = copy.deepcopy(self._data_vars_dict)
+                        if not new_ds:
+                            ds = nf1[var_name]
 
-                for var_name in vars_dict:
-                    shape = vars_dict[var_name]['shape']
-                    dims = vars_dict[var_name]['dims']
-                    maxshape = tuple([s if dims[i] not in unlimited_dims else None for i, s in enumerate(shape)])
+                            if (access_profile == 'auto') and (ds.chunks is not None):
+                                cache_kwargs = utils.chunk_cache_kwargs(ds.chunks, ds.dtype.itemsize, tuple(min(c*3, s) for c, s in zip(ds.chunks, shape)))
+                                del ds
+                                ds = utils.open_dataset(nf1, var_name, **cache_kwargs)
 
-                    chunks1 = utils.guess_chunk(shape, maxshape, vars_dict[var_name]['dtype'])
+                            if ds.shape != shape:
+                                ds.resize(shape)
 
-                    if isinstance(chunks, dict):
-                        if var_name in chunks:
-                            chunks1 = chunks[var_name]
+                            chunks1 = ds.chunks
 
-                    if len(shape) == 0:
-                        chunks1 = None
-                        compressor1 = {}
-                        vars_dict[var_name]['fillvalue'] = None
-                        maxshape = None
-                    else:
-                        compressor1 = compressor
+                        else:
+                            maxshape = tuple([s if dims[i] not in unlimited_dims else None for i, s in enumerate(shape)])
+
+                            chunks1 = utils.guess_chunk(shape, maxshape, vars_dict[var_name]['dtype'], utils.chunk_weights(dims, chunk_strategy, time_dims), target_size)
 
-                    ds = nf1.create_dataset(var_name, shape, chunks=chunks1, maxshape=maxshape, dtype=vars_dict[var_name]['dtype'], fillvalue=vars_dict[var_name]['fillvalue'], **compressor1)
+                            if isinstance(chunks, dict):
+                                if var_name in chunks:
+                                    chunks1 = chunks[var_name]
 
-                    ds_dims = ds.dims
-                    for i, dim in enumerate(dims):
-                        ds_dims[i].attach_scale(nf1[dim])
-                        ds_dims[i].label = dim
+                            if len(shape) == 0:
+                                chunks1 = None
+                                compressor1 = {}
+                                vars_dict[var_name]['fillvalue'] = None
+                                maxshape = None
+                            else:
+                                compressor1 = compressor
+
+                                if access_profile == 'auto':
+                                    compressor1 = dict(compressor1, **utils.chunk_cache_kwargs(chunks1, np.dtype(vars_dict[var_name]['dtype']).itemsize, tuple(min(c*3, s) for c, s in zip(chunks1, shape))))
 
-                    # Load the data by file
-                    for i in vars_dict[var_name]['data']:
-                        file = files[i]
+                            ds = nf1.create_dataset(var_name, shape, chunks=chunks1, maxshape=maxshape, dtype=vars_dict[var_name]['dtype'], fillvalue=vars_dict[var_name]['fillvalue'], **compressor1)
 
-                        ds_old = file[var_name]
+                            ds_dims = ds.dims
+                            for i, dim in enumerate(dims):
+                                ds_dims[i].attach_scale(nf1[dim])
+                                ds_dims[i].label = dim
 
+                            # Assigned before the data are loaded so that the raw chunks of inputs with other codecs are not copied
+                            if 'codecs' in encodings[var_name]:
+                                ds.attrs['codecs'] = json.dumps(encodings[var_name]['codecs'])
+
+                        # Load the data by file
                         if ds.chunks is None:
-                            if isinstance(ds_old, xr.DataArray):
-                                ds[()] = utils.encode_data(ds_old.values, **self._encodings[var_name])
-                            else:
-                                ds[()] = ds_old[()]
+                            for i in vars_dict[var_name]['data']:
+                                ds_old = files[i][var_name]
+
+                                if isinstance(ds_old, xr.DataArray):
+                                    if var_name in float_vars:
+                                        data = ds_old.values
+                                    else:
+                                        data = utils.encode_data(ds_old.values, **self._encodings[var_name])
+                                else:
+                                    data = utils.decode_codecs(ds_old[()], self._encodings[var_name].get('codecs', []))
+                                    if var_name in float_vars:
+                                        data = utils.decode_data(data, **self._encodings[var_name])
+
+                                ds[()] = utils.encode_codecs(data, encodings[var_name].get('codecs', []))
+                        elif new_ds and not np.dtype(vars_dict[var_name]['dtype']).hasobject:
+                            # The workers assemble, encode, and compress whole blocks of chunks and only this thread writes the raw chunks to the new file
+                            var_dict = vars_dict[var_name]
+                            blocks = utils.index_output_blocks(var_dict, chunks1)
+                            direct_ids = [i for i, index in var_dict['data'].items() if utils.is_direct_chunk_compatible(files[i][var_name], ds, index)]
+                            var_info = {'shape': shape, 'dtype': np.dtype(var_dict['dtype']), 'fillvalue': var_dict['fillvalue']}
+                            codecs1 = encodings[var_name].get('codecs', [])
+
+                            block_args = ((var_name, {i: var_dict['data'][i] for i in file_ids}, var_info, self._encodings[var_name], codecs1, block, chunks1, dict(compressor), direct_ids, access_profile, var_name in float_vars) for block, file_ids in blocks)
+
+                            for block_chunks in utils.imap_ordered(encode_block, block_args, n_workers, executor):
+                                for offset, filter_mask, chunk in block_chunks:
+                                    ds.id.write_direct_chunk(offset, chunk, filter_mask)
                         else:
-                            global_index = vars_dict[var_name]['data'][i]['global_index']
-                            local_index = vars_dict[var_name]['data'][i]['local_index']
-                            dims_order = vars_dict[var_name]['data'][i]['dims_order']
-                            local_dims = tuple(dims[i] for i in dims_order)
-                            transpose_order = tuple(dims_order.index(i) for i in range(len(dims_order)))
+                            var_chunks = utils.index_var_chunks(files, var_name, vars_dict[var_name], chunks1, ds, access_profile=access_profile)
+
+                            # Workers read and encode the blocks, but only this thread writes to the new file
+                            def read_block(global_chunk, ds_old, local_chunk, transpose_order, direct):
+                                if direct:
+                                    raw_chunk = utils.read_direct_chunk(ds_old, global_chunk, local_chunk, ds.chunks, ds.shape)
+                                    if raw_chunk is not None:
+                                        return global_chunk, None, raw_chunk
+
+                                data = utils.read_chunk(ds_old, local_chunk, transpose_order, self._encodings[var_name], var_name in float_vars)
+
+                                return global_chunk, utils.encode_codecs(data, encodings[var_name].get('codecs', [])), None
+
+                            for global_chunk, data, raw_chunk in utils.imap_ordered(read_block, var_chunks, n_workers):
+                                if raw_chunk is None:
+                                    ds[global_chunk] = data
+                                else:
+                                    filter_mask, chunk = raw_chunk
+                                    ds.id.write_direct_chunk(tuple(g.start for g in global_chunk), chunk, filter_mask)
+
+                    ## Existing variables that are not in the new data still need to cover the appended coordinate values
+                    if mode == 'a':
+                        for ds_name in nf1:
+                            ds = nf1[ds_name]
+                            if (ds_name in vars_dict) or (ds.attrs.get('CLASS') == b'DIMENSION_SCALE') or (len(ds.shape) == 0):
+                                continue
+
+                            shape = tuple(nf1[dim.label].shape[0] for dim in ds.dims)
+                            if ds.shape != shape:
+                                ds.resize(shape)
+
+                    ## Assign attrs
+                    for ds_name, attr in self._attrs.items():
+                        if ds_name in nf1:
+                            nf1[ds_name].attrs.update(attr)
+
+                    for ds_name, encs in encodings.items():
+                        if ds_name in nf1:
+                            for f, enc in encs.items():
+                                if 'dtype' in f:
+                                    enc = enc.name
+                                elif f in ('codecs', 'categories'):
+                                    enc = json.dumps(enc)
+                                nf1[ds_name].attrs.update({f: enc})
+
+                    nf1.attrs.update(self._global_attrs)
+
+                if isinstance(output, io.BytesIO):
+                    output.seek(0)
+            finally:
+                if executor is not None:
+                    executor.shutdown(cancel_futures=True)
+
+                utils.close_files(files)
+        else:
+            print('No data to save')
 
-                            global_chunks, local_chunks = utils.index_chunks(shape, chunks1, global_index, local_index, dims_order)
 
-                            if isinstance(ds_old, xr.DataArray):
-                                for global_chunk, local_chunk in zip(global_chunks, local_chunks):
-                                    data = ds_old[local_chunk].copy().load()
+    def _dask_chunks(self, var_name, chunks):
+        """
+        Resolve the dask chunks of a data variable from None, a tuple, or a dict of dim names to chunk sizes. Dims that are not specified use the auto-chunking shape.
+        """
+        var_dict = self._data_vars_dict[var_name]
+        auto_chunks = utils.guess_chunk(var_dict['shape'], var_dict['shape'], var_dict['dtype'])
+        if auto_chunks is None:
+            auto_chunks = ()
 
-                                    if dims == local_dims:
-                                        ds[global_chunk] = utils.encode_data(data.values, **self._encodings[var_name])
-                                    else:
-                                        ds[global_chunk] = utils.encode_data(data.values.transpose(dims_order), **self._encodings[var_name])
-                                    data.close()
-                                    del data
-                            else:
-                                for global_chunk, local_chunk in zip(global_chunks, local_chunks):
-                                    if dims == local_dims:
-                                        ds[global_chunk] = ds_old[local_chunk]
-                                    else:
-                                        ds[global_chunk] = ds_old[local_chunk].transpose(transpose_order)
+        if chunks is None:
+            chunks = auto_chunks
+        elif isinstance(chunks, dict):
+            chunks = tuple(chunks.get(dim, auto_chunks[i]) for i, dim in enumerate(var_dict['dims']))
+        elif len(chunks) != len(var_dict['dims']):
+            raise ValueError('The chunks for ' + var_name + ' must have the same number of dims as the data variable.')
 
-                ## Assign attrs
-                for ds_name, attr in self._attrs.items():
-                    if ds_name in nf1:
-                        nf1[ds_name].attrs.update(attr)
+        return tuple(chunks)
 
-                for ds_name, encs in self._encodings.items():
-                    if ds_name in nf1:
-                        for f, enc in encs.items():
-                            if 'dtype' in f:
-                                enc = enc.name
-                            nf1[ds_name].attrs.update({f: enc})
 
-                nf1.attrs.update(self._global_attrs)
+    def to_dask(self, var_name: str, chunks: Union[tuple, dict]=None):
+        """
+        Convert a data variable to a dask array without writing an intermediate file. Each block of the dask array is a task that reads and decodes the parts of the input files that intersect it, so the blocks can be read in parallel by the dask workers. Requires the dask package.
 
-            if isinstance(output, io.BytesIO):
-                output.seek(0)
+        Parameters
+        ----------
+        var_name : str
+            The name of the data variable.
+        chunks : tuple of int, dict, or None
+            The chunk shape of the dask array in the dims order of the data variable, or a dict of dim names to chunk sizes. None or dims missing from the dict will use the auto-chunking shape.
 
-            utils.close_files(files)
-        else:
-            print('No data to save')
+        Returns
+        -------
+        dask.array.Array
+        """
+        self._load_index()
+
+        if var_name not in self._data_vars_dict:
+            raise ValueError(var_name + ' is not one of the data variables.')
+
+        var_dict = self._data_vars_dict[var_name]
+        lazy_arr = utils.LazyArray(self._files, self._group, var_name, var_dict, self._encodings[var_name], self._access_profile)
+
+        return utils.to_dask_array(lazy_arr, self._dask_chunks(var_name, chunks))
 
 
-    def to_xarray(self):
+    def to_xarray(self, chunks: dict=None):
         """
-        Save an HDF5 file to an io.BytesIO object which is then opened by xr.open_dataset using the h5netcf engine.
+        Convert the combined data to an xr.Dataset. The coordinates are loaded into memory, but the data variables are lazy arrays that read and decode only the requested parts straight from the input files (e.g. when using .sel/.isel and .values or .load()).
+
+        Parameters
+        ----------
+        chunks : dict or None
+            If a dict of dim names to chunk sizes is passed (an empty dict is fine), then the data variables will be dask arrays (see to_dask). Dims missing from the dict will use the auto-chunking shape. Requires the dask package.
 
         Returns
         -------
         xr.Dataset
         """
+        self._load_index()
+
         if self._coords_dict:
-            b1 = io.BytesIO()
+            ## The units of data that aren't CF times are attrs in xarray
+            attrs = {}
+            encodings = {}
+            for k, enc in self._encodings.items():
+                attrs[k] = utils.xr_attrs(self._attrs.get(k, {}))
+                encodings[k] = enc.copy()
+                if ('units' in enc) and ('calendar' not in enc):
+                    attrs[k]['units'] = encodings[k].pop('units')
+
+            coords = {}
+            for k, v in self._coords_dict.items():
+                data = utils.decode_data(v, **self._encodings[k])
+                if 'datetime64' in data.dtype.name:
+                    data = data.astype('datetime64[ns]')
+                coords[k] = xr.Variable(k, data, attrs=attrs[k], encoding=encodings[k])
 
-            self.to_hdf5(b1)
+            data_vars = {}
+            for k, v in self._data_vars_dict.items():
+                if chunks is None:
+                    lazy_arr = xr.core.indexing.LazilyIndexedArray(utils.LazyArray(self._files, self._group, k, v, self._encodings[k], self._access_profile))
+                else:
+                    lazy_arr = self.to_dask(k, chunks)
+                data_vars[k] = xr.Variable(v['dims'], lazy_arr, attrs=attrs[k], encoding=encodings[k])
 
-            xr_ds = xr.open_dataset(b1, engine='h5netcdf')
+            xr_ds = xr.Dataset(data_vars=data_vars, coords=coords, attrs=utils.xr_attrs(self._global_attrs))
         else:
             xr_ds = xr.Dataset()
 
@@ -449,7 +859,7 @@ class H5(object):
 ### Convenience functions
 
 
-def xr_to_hdf5(data: Union[List[xr.Dataset], xr.Dataset], output: Union[str, pathlib.Path, io.BytesIO], group=None, chunks=None, unlimited_dims=None, compression='zstd'):
+def xr_to_hdf5(data: Union[List[xr.Dataset], xr.Dataset], output: Union[str, pathlib.Path, io.BytesIO], group=None, chunks=None, unlimited_dims=None, compression='zstd', n_workers=None):
     """
     Convenience function to take one or more xr.Datasets and output the data to an HDF5 file or file object.
 
@@ -467,12 +877,14 @@ def xr_to_hdf5(data: Union[List[xr.Dataset], xr.Dataset], output: Union[str, pat
         The dimensions/coordinates that should be assigned as "unlimited" in the hdf5 file.
     compression : str
         The compression used for the chunks in the hdf5 files. Must be one of gzip, lzf, zstd, or None. gzip is compatible with any hdf5 installation (not only h5py), so this should be used if interoperability across platforms is important. lzf is compatible with any h5py installation, so if only python users will need to access these files then this is a better option than gzip. zstd requires the hdf5plugin python package, but is the best compression option if users have access to the hdf5plugin package. None has no compression and is generally not recommended except in niche situations.
+    n_workers : int or None
+        The number of worker threads used to read, encode, and compress the blocks of chunks from the input datasets. None or 1 runs everything in the calling thread.
 
     Returns
     -------
     None
     """
-    H5(data).to_hdf5(output, group, chunks, unlimited_dims, compression)
+    H5(data).to_hdf5(output, group, chunks, unlimited_dims, compression, n_workers)
 
 
 
@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the H5 building blocks. Run this file directly (it is not part of the test suite).
+"""
+import os
+import io
+import glob
+import h5py
+import hdf5plugin
+import numpy as np
+import xarray as xr
+import pickle
+import tracemalloc
+from time import perf_counter
+from hdf5tools import H5, utils
+
+#############################################
+### Parameters
+
+file_counts = [100, 500, 1000, 2000, 5000]
+hours_per_file = 24
+
+start_time = np.datetime64('2000-01-01T00:00:00', 's').astype('int64')
+
+############################################
+### Functions
+
+
+def time_func(func, *args, n=3):
+    """
+    The minimum run time (in seconds) of n runs.
+    """
+    times = []
+    for i in range(n):
+        t1 = perf_counter()
+        func(*args)
+        times.append(perf_counter() - t1)
+
+    return min(times)
+
+
+def hourly_manifests(n_files):
+    """
+    Manifests of n_files consecutive files with hours_per_file hourly times each.
+    """
+    manifests = []
+    for i in range(n_files):
+        times = start_time + (np.arange(hours_per_file) + i*hours_per_file) * 3600
+        manifests.append({'coords': {'time': times}})
+
+    return manifests
+
+
+def extend_coords_union1d(manifests):
+    """
+    The previous implementation of utils.extend_coords for comparison.
+    """
+    coords_dict = {}
+
+    for manifest in manifests:
+        for ds_name, data in manifest['coords'].items():
+            if ds_name in coords_dict:
+                coords_dict[ds_name] = np.union1d(coords_dict[ds_name], data)
+            else:
+                coords_dict[ds_name] = data
+
+    return coords_dict
+
+
+def bench_extend_coords():
+    """
+    Scaling of the coordinate union with the number of files.
+    """
+    print('extend_coords: files, union1d per file (s), concatenate then unique (s)')
+    for n_files in file_counts:
+        manifests = hourly_manifests(n_files)
+        t_old = time_func(extend_coords_union1d, manifests)
+        t_new = time_func(utils.extend_coords, manifests)
+        print(n_files, round(t_old, 4), round(t_new, 4))
+
+
+def bench_chunk_plan():
+    """
+    Memory of the chunk plan of a large dataset.
+    """
+    print('index_chunks: blocks, plan peak memory (MB), blocks per second')
+    for n_stations in [100, 1000, 10000]:
+        shape = (n_stations, 100000)
+        chunks = (1, 10000)
+        global_index = [slice(0, shape[0]), slice(0, shape[1])]
+        local_index = global_index
+
+        tracemalloc.start()
+        plan = utils.index_chunks(shape, chunks, global_index, local_index, (0, 1))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        t1 = perf_counter()
+        n_blocks = sum(1 for block in plan)
+        rate = n_blocks/(perf_counter() - t1)
+
+        print(n_blocks, round(peak/1024/1024, 3), int(rate))
+
+
+def bench_filter_coords():
+    """
+    Latency of a one week slice selection on long hourly time coordinates (sorted binary search vs decode and mask).
+    """
+    print('filter_coords: times, decode and mask (s), binary search (s)')
+    encodings = {'time': {'dtype': np.dtype('int64'), 'dtype_decoded': np.dtype('datetime64[s]'), 'units': 'seconds since 1970-01-01 00:00:00', 'calendar': 'gregorian'}}
+    selection = {'time': slice('2001-01-01', '2001-01-08')}
+
+    for n_times in [10**5, 10**6, 10**7]:
+        times = start_time + np.arange(n_times) * 3600
+
+        t_old = time_func(lambda: times[utils.slice_mask(utils.decode_data(times, **encodings['time']), selection['time'])])
+        t_new = time_func(lambda: utils.filter_coords({'time': times}, selection, encodings))
+        print(n_times, round(t_old, 6), round(t_new, 6))
+
+
+def bench_index_table():
+    """
+    Memory and pickled size of the per-file indexes of one variable as a dict of dicts and as an IndexTable.
+    """
+    print('IndexTable: files, dicts memory (MB), table memory (MB), dicts pickled (MB), table pickled (MB)')
+    for n_files in [1000, 10000, 50000]:
+        indexes = {}
+        for i in range(n_files):
+            indexes[i] = {'dims_order': (0, 1), 'global_index': [slice(i, i + 1), slice(i*hours_per_file, (i + 1)*hours_per_file)], 'local_index': [slice(0, 1), slice(0, hours_per_file)]}
+
+        tracemalloc.start()
+        dicts = {i: {'dims_order': index['dims_order'], 'global_index': list(index['global_index']), 'local_index': list(index['local_index'])} for i, index in indexes.items()}
+        dicts_mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        tracemalloc.start()
+        table = utils.IndexTable(2)
+        for i, index in indexes.items():
+            table[i] = index
+        table = table.copy()
+        table_mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        print(n_files, round(dicts_mem/1024/1024, 3), round(table_mem/1024/1024, 3), round(len(pickle.dumps(dicts))/1024/1024, 3), round(len(pickle.dumps(table))/1024/1024, 3))
+
+
+def get_encodings(files):
+    """
+    The previous encodings extraction (a separate walk over the files) for comparison.
+    """
+    # file_encs = {}
+    encs = {}
+    for i, file in enumerate(files):
+        # file_encs[i] = {}
+        if isinstance(file, xr.Dataset):
+            ds_list = list(file.variables)
+        else:
+            ds_list = list(file.keys())
+
+        for name in ds_list:
+            enc = utils.get_encoding(file[name])
+            enc = utils.assign_dtype_decoded(enc)
+            # file_encs[i].update({name: enc})
+
+            if name in encs:
+                encs[name].update(enc)
+            else:
+                encs[name] = enc
+
+        for name, enc in encs.items():
+            enc = utils.assign_dtype_decoded(enc)
+            encs[name] = enc
+
+    return encs
+
+
+def get_attrs(files):
+    """
+    The previous attrs extraction (a separate walk over the files) for comparison.
+    """
+    # file_attrs = {}
+    global_attrs = {}
+    attrs = {}
+    for i, file in enumerate(files):
+        global_attrs.update(dict(file.attrs))
+
+        # file_attrs[i] = {}
+        for name in file:
+            attr = utils.filter_attrs(file[name].attrs)
+            # file_attrs[i].update({name: attr})
+
+            if name in attrs:
+                attrs[name].update(attr)
+            else:
+                attrs[name] = attr
+
+    return attrs, global_attrs
+
+
+def is_scale(dataset):
+    """
+
+    """
+    check = h5py.h5ds.is_scale(dataset._id)
+
+    return check
+
+
+def scan_file_multipass(file):
+    """
+    The previous metadata extraction for comparison: separate walks over the file for the encodings, the attrs, the coordinates, and the dims of the data variables (reading each dimension scale through dim[0][:]).
+    """
+    encodings = get_encodings([file])
+    attrs, global_attrs = get_attrs([file])
+
+    coords = {ds_name: file[ds_name][:] for ds_name in file.keys() if is_scale(file[ds_name])}
+
+    data_vars = {}
+    for ds_name in file.keys():
+        if not is_scale(file[ds_name]):
+            ds = file[ds_name]
+            data_vars[ds_name] = tuple(dim[0].name.split('/')[-1] for dim in ds.dims)
+            for dim in ds.dims:
+                _ = dim[0][:]
+
+    return encodings, attrs, global_attrs, coords, data_vars
+
+
+def count_hdf5_calls(func, *args):
+    """
+    Count the calls into the HDF5 library that open or look up objects and attributes while running func.
+    """
+    counts = {}
+    patched = []
+    for mod, name in [(h5py.h5o, 'open'), (h5py.h5a, 'open'), (h5py.h5ds, 'is_scale'), (h5py.h5ds, 'iterate')]:
+        orig = getattr(mod, name)
+
+        def counter(*a, _orig=orig, _key=mod.__name__ + '.' + name, **k):
+            counts[_key] = counts.get(_key, 0) + 1
+            return _orig(*a, **k)
+
+        setattr(mod, name, counter)
+        patched.append((mod, name, orig))
+
+    try:
+        func(*args)
+    finally:
+        for mod, name, orig in patched:
+            setattr(mod, name, orig)
+
+    return counts
+
+
+def bench_scan_file():
+    """
+    HDF5 object accesses and run time of the metadata extraction of the test datasets.
+    """
+    print('scan_file: file, multipass accesses, single pass accesses, multipass (s), single pass (s)')
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'datasets', '*.nc'))):
+        with h5py.File(path, 'r') as file:
+            old = count_hdf5_calls(scan_file_multipass, file)
+            new = count_hdf5_calls(utils.scan_file, file)
+            t_old = time_func(scan_file_multipass, file)
+            t_new = time_func(utils.scan_file, file)
+
+        print(os.path.basename(path), sum(old.values()), sum(new.values()), round(t_old, 4), round(t_new, 4))
+
+
+def bench_datetime():
+    """
+    Decoding and encoding of times with units that are not since 1970-01-01 (numpy vs cftime).
+    """
+    import cftime
+
+    units = 'hours since 1900-01-01 00:00:00'
+    print('datetime: times, cftime decode (s), numpy decode (s), cftime encode (s), numpy encode (s)')
+    for n_times in [10**4, 10**5, 10**6]:
+        nums = np.arange(n_times, dtype='int64') + 876576
+        dates = utils.decode_datetime(nums, units, 'gregorian')
+
+        t_cf_dec = time_func(lambda: cftime.num2pydate(nums, units, 'gregorian').astype('datetime64[s]'), n=1)
+        t_np_dec = time_func(utils.decode_datetime, nums, units, 'gregorian')
+        t_cf_enc = time_func(lambda: cftime.date2num(dates.tolist(), units, 'gregorian'), n=1)
+        t_np_enc = time_func(utils.encode_datetime, dates, units, 'gregorian')
+
+        print(n_times, round(t_cf_dec, 4), round(t_np_dec, 4), round(t_cf_enc, 4), round(t_np_enc, 4))
+
+
+def bench_scale_codec():
+    """
+    Peak memory and time of the scale/offset encoding and decoding of one chunk vs the full-size expressions.
+    """
+    encoding = {'dtype': np.dtype('int16'), 'dtype_decoded': np.dtype('float32'), 'missing_value': -9999, 'add_offset': 0, 'scale_factor': 0.01}
+
+    def encode_old(data):
+        data = np.round((data - encoding['add_offset'])/encoding['scale_factor'])
+        data[np.isnan(data)] = encoding['missing_value']
+        return data.astype(encoding['dtype'])
+
+    def decode_old(data):
+        data = data.astype(encoding['dtype_decoded'])
+        data[data == encoding['missing_value']] = np.nan
+        return (data * encoding['scale_factor']) + encoding['add_offset']
+
+    def peak(func, *args):
+        tracemalloc.start()
+        func(*args)
+        p = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return p
+
+    print('scale codec: chunk (MB), old encode peak (MB), new encode peak (MB), old decode peak (MB), new decode peak (MB), old encode (s), new encode (s), old decode (s), new decode (s)')
+    for n in [10**5, 10**6, 10**7]:
+        data = (np.random.default_rng(1).random(n) * 100).astype('float32')
+        encoded = utils.encode_data(data, **encoding)
+
+        mb = [round(peak(f, d)/1e6, 2) for f, d in ((encode_old, data), (lambda d: utils.encode_data(d, **encoding), data), (decode_old, encoded), (lambda d: utils.decode_data(d, **encoding), encoded))]
+        times = [round(time_func(f, d), 4) for f, d in ((encode_old, data), (lambda d: utils.encode_data(d, **encoding), data), (decode_old, encoded), (lambda d: utils.decode_data(d, **encoding), encoded))]
+
+        print(round(data.nbytes/1e6, 2), *mb, *times)
+
+
+def bench_bitround():
+    """
+    Output size of float32 data (a random walk per column) with zstd and the bitround codec.
+    """
+    rng = np.random.default_rng(0)
+    data = (np.cumsum(rng.normal(0, 0.05, (2000, 500)), axis=0) + 15).astype('float32')
+
+    print('bitround: keepbits, output size (MB)')
+    for keepbits in [23, 12, 10, 7]:
+        x1 = xr.Dataset({'temp': (('time', 'station'), data)}, coords={'time': np.arange(2000, dtype='int32'), 'station': np.arange(500, dtype='int32')})
+        x1['temp'].encoding = {'codecs': [{'id': 'bitround', 'keepbits': keepbits}]}
+
+        b1 = io.BytesIO()
+        H5(x1).to_hdf5(b1)
+
+        print(keepbits, round(len(b1.getvalue())/1e6, 2))
+
+
+def bench_string_storage():
+    """
+    Output size and coordinate read time of a string coordinate with each string storage, and the union of string coordinates as object vs unicode arrays.
+    """
+    n = 200000
+    station_ids = np.array(['station_' + str(i).zfill(7) for i in range(n)])
+
+    print('string storage: storage, output size (MB), read_coord (s)')
+    for storage in utils.string_storages:
+        encoding = {'dtype': h5py.string_dtype()}
+        encoding.update(utils.string_storage_encoding(station_ids, storage))
+
+        b1 = io.BytesIO()
+        with h5py.File(b1, 'w') as f:
+            ds = f.create_dataset('station_id', station_ids.shape, dtype=encoding['dtype'], chunks=(65536,), **hdf5plugin.Zstd(1))
+            ds[:] = utils.encode_strings(station_ids, encoding)
+
+        with h5py.File(b1, 'r') as f:
+            t = time_func(utils.read_coord, f['station_id'], dict(encoding, dtype=h5py.string_dtype()))
+
+        print(storage, round(len(b1.getvalue())/1e6, 2), round(t, 4))
+
+    obj1 = station_ids[::2].astype(object)
+    obj2 = station_ids[1::2].astype(object)
+    print('string union: object (s), unicode (s)')
+    print(round(time_func(np.union1d, obj1, obj2), 4), round(time_func(np.union1d, station_ids[::2], station_ids[1::2]), 4))
+
+
+def bench_chunk_strategy():
+    """
+    Read times of the two main access patterns (the whole time series of one station and one time step of all stations) of hourly data with each chunk strategy.
+    """
+    import tempfile
+
+    n_times = 17520
+    n_stations = 1000
+    rng = np.random.default_rng(0)
+    data = (np.cumsum(rng.normal(0, 0.1, (n_times, n_stations)), axis=0) + 15).astype('float32')
+    times = np.arange('2000-01-01', n_times, dtype='datetime64[h]').astype('datetime64[ns]')
+
+    x1 = xr.Dataset({'temp': (('time', 'station'), data)}, coords={'time': times, 'station': np.arange(n_stations, dtype='int32')})
+    x1['temp'].encoding = {'dtype': 'int16', 'scale_factor': 0.01, '_FillValue': -32768}
+    h1 = H5(x1)
+
+    stations = rng.choice(n_stations, 20, replace=False)
+    time_steps = rng.choice(n_times, 20, replace=False)
+
+    def read_series(path):
+        with h5py.File(path, 'r') as f:
+            ds = f['temp']
+            for s in stations:
+                ds[:, s]
+
+    def read_time_steps(path):
+        with h5py.File(path, 'r') as f:
+            ds = f['temp']
+            for t in time_steps:
+                ds[t, :]
+
+    print('chunk strategy: strategy, chunks, 20 station time series (s), 20 time steps (s)')
+    with tempfile.TemporaryDirectory() as tmp_path:
+        for strategy in [None, 'timeseries', 'spatial', 'balanced']:
+            path = os.path.join(tmp_path, str(strategy) + '.h5')
+            h1.to_hdf5(path, chunk_strategy=strategy)
+
+            with h5py.File(path, 'r') as f:
+                chunks = f['temp'].chunks
+
+            print(strategy, chunks, round(time_func(read_series, path), 4), round(time_func(read_time_steps, path), 4))
+
+
+def bench_to_hdf5_workers():
+    """
+    Write times of to_hdf5 with more workers for many input files on disk. The blocks are encoded and compressed in the workers, so the output must be identical to the serial output.
+    """
+    import tempfile
+
+    n_files = 24
+    n_times = 720
+    n_stations = 500
+    rng = np.random.default_rng(0)
+
+    print('to_hdf5 workers: n_workers, write time (s), identical to serial')
+    with tempfile.TemporaryDirectory() as tmp_path:
+        paths = []
+        for i in range(n_files):
+            data = (np.cumsum(rng.normal(0, 0.1, (n_times, n_stations)), axis=0) + 15).astype('float32')
+            times = (np.datetime64('2000-01-01', 'h') + i*n_times + np.arange(n_times)).astype('datetime64[ns]')
+            x1 = xr.Dataset({'temp': (('time', 'station'), data)}, coords={'time': times, 'station': np.arange(n_stations, dtype='int32')})
+            x1['temp'].encoding = {'dtype': 'int16', 'scale_factor': 0.01, '_FillValue': -32768, 'chunksizes': (96, 100), 'compression': 'gzip'}
+            path = os.path.join(tmp_path, str(i) + '.h5')
+            x1.to_netcdf(path, engine='h5netcdf')
+            paths.append(path)
+
+        h1 = H5(paths)
+
+        def write(n_workers):
+            b1 = io.BytesIO()
+            h1.to_hdf5(b1, chunks={'temp': (720, 100)}, n_workers=n_workers)
+            return b1
+
+        serial = write(None).getvalue()
+        for n_workers in [None, 2, 4, os.cpu_count()]:
+            identical = write(n_workers).getvalue() == serial
+            print(n_workers, round(time_func(write, n_workers), 3), identical)
+
+
+############################################
+### Run
+
+if __name__ == '__main__':
+    bench_extend_coords()
+    bench_chunk_plan()
+    bench_filter_coords()
+    bench_index_table()
+    bench_scan_file()
+    bench_datetime()
+    bench_scale_codec()
+    bench_bitround()
+    bench_string_storage()
+    bench_chunk_strategy()
+    bench_to_hdf5_workers()
@@ -3,11 +3,15 @@ Created on 2021-04-27.
 
 @author: Mike K
 """
-from hdf5tools import H5
+from hdf5tools import H5, utils
 import os
+import io
+import shutil
 import pytest
 from glob import glob
 import xarray as xr
+import numpy as np
+import h5py
 
 ##############################################
 ### Parameters
@@ -205,9 +209,1002 @@ def test_H5_mix(ds_id):
     os.remove(new_path)
 
 
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_n_workers(ds_id):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+
+    b1 = io.BytesIO()
+    h1.to_hdf5(b1)
+    x1 = xr.open_dataset(b1, engine='h5netcdf').load()
+
+    b2 = io.BytesIO()
+    h1.to_hdf5(b2, n_workers=4)
+
+    assert b1.getvalue() == b2.getvalue()
+
+    x2 = xr.open_dataset(b2, engine='h5netcdf').load()
+
+    assert x1.equals(x2)
+
+
+def test_H5_to_hdf5_cleanup(monkeypatch):
+    """
+
+    """
+    ds_files = [f for f in files if '0b2bd62cc42f3096136f11e9' in f]
+    h1 = H5(ds_files)
+
+    block_executor = utils.block_executor
+    executors = []
+    closed = []
+
+    def record_executor(*args):
+        executor, func = block_executor(*args)
+        executors.append(executor)
+        return executor, func
+
+    def record_close(files):
+        closed.append(files)
+
+    monkeypatch.setattr(utils, 'block_executor', record_executor)
+    monkeypatch.setattr(utils, 'close_files', record_close)
+
+    with pytest.raises(ValueError):
+        h1.to_hdf5(io.BytesIO(), n_workers=2, access_profile='fast')
+
+    assert len(closed) == 1
+
+    # A shut down executor doesn't take new tasks
+    with pytest.raises(RuntimeError):
+        executors[0].submit(print)
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_direct_chunks(ds_id, monkeypatch):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+    b1 = io.BytesIO()
+    H5(ds_files).to_hdf5(b1)
+    x1 = xr.open_dataset(b1, engine='h5netcdf').load()
+
+    read_direct_chunk = utils.read_direct_chunk
+    raw_chunks = []
+
+    def count_raw_chunks(*args):
+        raw_chunk = read_direct_chunk(*args)
+        if raw_chunk is not None:
+            raw_chunks.append(raw_chunk)
+        return raw_chunk
+
+    monkeypatch.setattr(utils, 'read_direct_chunk', count_raw_chunks)
+
+    b2 = io.BytesIO()
+    H5(b1).to_hdf5(b2)
+
+    with h5py.File(b1, 'r') as f:
+        n_chunks = sum(ds.id.get_num_chunks() for ds_name, ds in f.items() if (ds.chunks is not None) and (ds.attrs.get('CLASS') != b'DIMENSION_SCALE') and not ds.dtype.hasobject)
+
+    assert n_chunks > 0
+    assert len(raw_chunks) == n_chunks
+    x2 = xr.open_dataset(b2, engine='h5netcdf').load()
+
+    assert x1.equals(x2)
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_lazy(ds_id):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files, lazy=True)
+    assert h1._coords_dict is None
+
+    b1 = io.BytesIO()
+    h1.to_hdf5(b1)
+    x1 = xr.open_dataset(b1, engine='h5netcdf').load()
+
+    b2 = io.BytesIO()
+    H5(ds_files).to_hdf5(b2)
+    x2 = xr.open_dataset(b2, engine='h5netcdf').load()
+
+    assert x1.equals(x2)
+
+    first_times = x1.time.values[0:5]
+    h2 = H5(ds_files, lazy=True).sel({'time': slice(first_times[0], first_times[-1])})
+    assert h2.coords()['time']['shape'][0] == 4
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_cache(ds_id, tmp_path, monkeypatch):
+    """
+
+    """
+    ds_files = []
+    for f in files:
+        if ds_id in f:
+            ds_files.append(str(tmp_path.joinpath(os.path.basename(f))))
+            shutil.copyfile(f, ds_files[-1])
+    cache = tmp_path.joinpath('cache')
+
+    scan_path = utils.scan_path
+    scanned = []
+
+    def count_scans(path, *args):
+        scanned.append(path)
+        return scan_path(path, *args)
+
+    monkeypatch.setattr(utils, 'scan_path', count_scans)
+
+    h1 = H5(ds_files[:1], cache=cache)
+    assert scanned == ds_files[:1]
+
+    h2 = H5(ds_files, cache=cache)
+    assert scanned == ds_files
+
+    # All of the files are cached
+    h3 = H5(ds_files, cache=cache)
+    assert scanned == ds_files
+
+    # A modified file is scanned again
+    stat = os.stat(ds_files[-1])
+    os.utime(ds_files[-1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    H5(ds_files, cache=cache)
+    assert scanned == ds_files + ds_files[-1:]
+
+    b1 = io.BytesIO()
+    h1.to_hdf5(b1)
+    b2 = io.BytesIO()
+    h2.to_hdf5(b2)
+    b3 = io.BytesIO()
+    h3.to_hdf5(b3)
+    b4 = io.BytesIO()
+    H5(ds_files).to_hdf5(b4)
+
+    x2 = xr.open_dataset(b2, engine='h5netcdf').load()
+    x3 = xr.open_dataset(b3, engine='h5netcdf').load()
+    x4 = xr.open_dataset(b4, engine='h5netcdf').load()
+
+    assert x2.equals(x4)
+    assert x3.equals(x4)
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_append(ds_id):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+
+    for ds_files1 in [ds_files, ds_files[::-1]]:
+        h1 = H5(ds_files1[:1])
+        h1.append(ds_files1[1:])
+        b1 = io.BytesIO()
+        h1.to_hdf5(b1)
+        x1 = xr.open_dataset(b1, engine='h5netcdf').load()
+
+        b2 = io.BytesIO()
+        H5(ds_files1).to_hdf5(b2)
+        x2 = xr.open_dataset(b2, engine='h5netcdf').load()
+
+        assert x1.equals(x2)
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_to_hdf5_append(ds_id):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+
+    b1 = io.BytesIO()
+    h1.to_hdf5(b1)
+    x1 = xr.open_dataset(b1, engine='h5netcdf').load()
+
+    mid_time = x1.time.values[len(x1.time)//2]
+
+    b2 = io.BytesIO()
+    h1.sel({'time': slice(None, mid_time)}).to_hdf5(b2, unlimited_dims='time')
+    h1.sel({'time': slice(mid_time, None)}).to_hdf5(b2, mode='a')
+    x2 = xr.open_dataset(b2, engine='h5netcdf').load()
+
+    assert x1.equals(x2)
+
+    b3 = io.BytesIO()
+    h1.sel({'time': slice(mid_time, None)}).to_hdf5(b3, unlimited_dims='time')
+    with pytest.raises(ValueError):
+        h1.sel({'time': slice(None, mid_time)}).to_hdf5(b3, mode='a')
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_to_hdf5_append_missing_vars(ds_id):
+    """
+    Variables in the file that are not in the appended data must still be resized to the appended coordinates.
+    """
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+
+    b1 = io.BytesIO()
+    h1.to_hdf5(b1)
+    x1 = xr.open_dataset(b1, engine='h5netcdf').load()
+
+    geo = h1._coords_dict['geometry']
+    if len(geo) < 2:
+        return
+
+    mid = geo[len(geo)//2]
+
+    # The second part is missing one of the variables
+    var_name = [v for v in h1._data_vars_dict if 'geometry' in h1._data_vars_dict[v]['dims']][0]
+
+    b2 = io.BytesIO()
+    h1.sel({'geometry': geo[geo < mid]}).to_hdf5(b2, unlimited_dims='geometry')
+    h1.sel({'geometry': geo[geo >= mid]}, exclude_data_vars=[var_name]).to_hdf5(b2, mode='a')
+    x2 = xr.open_dataset(b2, engine='h5netcdf').load()
+
+    for v in x2.data_vars:
+        assert x2[v].shape == x1[v].shape
+
+    assert x1.drop_vars(var_name).equals(x2.drop_vars(var_name))
+    assert x1[var_name].sel(geometry=geo[geo < mid]).equals(x2[var_name].sel(geometry=geo[geo < mid]))
+
+
+def test_H5_to_hdf5_append_rejected():
+    """
+    An append that fails on any of the coordinates or existing datasets must not change the file.
+    """
+    def station_ds(stations, times, dims=('station', 'time')):
+        temp = np.arange(len(stations)*len(times), dtype='int16').reshape(len(stations), len(times))
+        if dims[0] == 'time':
+            temp = temp.T
+        return xr.Dataset({'temp': (dims, temp), 'elev': (('station',), np.arange(len(stations), dtype='int32'))}, coords={'station': np.array(stations, dtype=object), 'time': times})
+
+    times = np.arange('2020-01-01T00', '2020-01-01T10', dtype='datetime64[h]').astype('datetime64[ns]')
+
+    b1 = io.BytesIO()
+    H5(station_ds(list('abcdefg'), times)).to_hdf5(b1, unlimited_dims='station')
+    before = b1.getvalue()
+
+    # A new station (which could be appended) with new times (which can't)
+    with pytest.raises(ValueError):
+        H5(station_ds(['zz'], times + np.timedelta64(5, 'h'))).to_hdf5(b1, mode='a')
+    assert b1.getvalue() == before
+
+    # A new station with the dims of temp in another order
+    with pytest.raises(ValueError):
+        H5(station_ds(['zz'], times, ('time', 'station'))).to_hdf5(b1, mode='a')
+    assert b1.getvalue() == before
+
+    x1 = H5(b1).to_xarray().load()
+    assert x1['temp'].shape == (7, 10)
+
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_iter_chunks(ds_id):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+
+    b1 = io.BytesIO()
+    h1.to_hdf5(b1)
+    x1 = xr.open_dataset(b1, engine='h5netcdf', decode_times=False, mask_and_scale=False).load()
+
+    for var_name, var in h1.data_vars().items():
+        if 'datetime' in var['dtype_decoded'].name:
+            arr = np.full(var['shape'], np.datetime64('NaT'), dtype=var['dtype_decoded'])
+        elif 'float' in var['dtype_decoded'].name:
+            arr = np.full(var['shape'], np.nan, dtype=var['dtype_decoded'])
+        else:
+            arr = np.empty(var['shape'], dtype=var['dtype_decoded'])
+
+        for global_slice, data in h1.iter_chunks(var_name, tuple(max(s//3, 1) for s in var['shape'])):
+            arr[global_slice] = data
+
+        expected = utils.decode_data(x1[var_name].values, **h1._encodings[var_name])
+        if 'float' in var['dtype_decoded'].name:
+            assert np.allclose(arr, expected, equal_nan=True)
+        else:
+            assert np.array_equal(arr.astype(str), expected.astype(str))
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_to_xarray(ds_id):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+
+    b1 = io.BytesIO()
+    h1.to_hdf5(b1)
+    x1 = xr.open_dataset(b1, engine='h5netcdf').load()
+
+    x2 = h1.to_xarray()
+    assert set(x2.variables) == set(x1.variables)
+
+    for x3, x4 in [(x1, x2), (x1.isel(time=slice(1, 30, 3)), x2.isel(time=slice(1, 30, 3))), (x1.isel(time=2, geometry=-1), x2.isel(time=2, geometry=-1))]:
+        for var_name in x3.variables:
+            arr3 = x3[var_name].values
+            arr4 = x4[var_name].values
+            if arr3.dtype.kind == 'f':
+                assert np.allclose(arr3, arr4, equal_nan=True)
+            else:
+                assert np.array_equal(arr3.astype(str), arr4.astype(str))
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_to_xarray_attrs(ds_id, tmp_path):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+    x1 = xr.open_dataset(ds_files[0], engine='h5netcdf')
+
+    x2 = H5(ds_files).to_xarray()
+
+    assert '_NCProperties' not in x2.attrs
+    assert not any(isinstance(v, bytes) for v in x2.attrs.values())
+
+    for var_name in set(x2.variables).intersection(x1.variables):
+        assert x2[var_name].attrs.get('units') == x1[var_name].attrs.get('units')
+        if var_name == 'time':
+            assert x2[var_name].encoding['units'] == x1[var_name].encoding['units']
+
+    path = tmp_path.joinpath('test.nc')
+    x2.to_netcdf(path, engine='h5netcdf')
+    x3 = xr.open_dataset(path, engine='h5netcdf').load()
+
+    assert x3.identical(x2.load())
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_to_dask(ds_id):
+    """
+
+    """
+    pytest.importorskip('dask')
+
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+
+    x1 = h1.to_xarray().load()
+    x2 = h1.to_xarray(chunks={'time': 10})
+
+    for var_name in x2.data_vars:
+        assert x2[var_name].chunks is not None
+        if 'time' in x2[var_name].dims:
+            assert x2[var_name].data.chunks[x2[var_name].dims.index('time')][0] == 10
+
+    x2 = x2.load()
+    for var_name in x1.variables:
+        arr1 = x1[var_name].values
+        arr2 = x2[var_name].values
+        if arr1.dtype.kind == 'f':
+            assert np.allclose(arr1, arr2, equal_nan=True)
+        else:
+            assert np.array_equal(arr1, arr2, equal_nan=arr1.dtype.kind != 'O')
+
+    with pytest.raises(ValueError):
+        h1.to_dask('time')
+
+
+def test_index_coord():
+    """
+
+    """
+    coord_data = np.arange(10)
+
+    ## Sorted file coords that overlap contiguously are sliced
+    assert utils.index_coord(coord_data, np.arange(3, 7)) == (slice(3, 7), slice(0, 4))
+    assert utils.index_coord(coord_data, np.arange(8, 14)) == (slice(8, 10), slice(0, 2))
+    assert utils.index_coord(coord_data, np.arange(-2, 1)) == (slice(0, 1), slice(2, 3))
+
+    ## Non-contiguous overlaps fall back to index arrays
+    global_index, local_index = utils.index_coord(coord_data, np.array([1, 3, 5]))
+    assert np.array_equal(global_index, [1, 3, 5])
+    assert local_index == slice(0, 3)
+    assert not global_index.flags.writeable
+
+    global_index, local_index = utils.index_coord(np.array([0, 2, 4, 6]), np.arange(5))
+    assert global_index == slice(0, 3)
+    assert np.array_equal(local_index, [0, 2, 4])
+
+    ## Unsorted file coords
+    global_index, local_index = utils.index_coord(coord_data, np.array([5, 3, 4]))
+    assert global_index == slice(3, 6)
+    assert np.array_equal(local_index, [1, 2, 0])
+
+    global_index, local_index = utils.index_coord(coord_data, np.array([7, 1, 4]))
+    assert np.array_equal(global_index, [1, 4, 7])
+    assert np.array_equal(local_index, [1, 2, 0])
+
+    ## No overlap
+    assert utils.index_coord(coord_data, np.array([20, 21])) is None
+    assert utils.index_coord(coord_data, np.array([-3, -1])) is None
+    assert utils.index_coord(coord_data, np.array([0.5, 2.5])) is None
+    assert utils.index_coord(coord_data, np.array([], dtype='int64')) is None
+
+
+def test_index_axis_blocks():
+    """
+
+    """
+    def blocks(g_index, l_index, chunk_size):
+        return [tuple(int(v) for v in b) for b in zip(*utils.index_axis_blocks(g_index, l_index, chunk_size))]
+
+    ## Slices are split at the chunk boundaries
+    assert blocks(slice(5, 25), slice(0, 20), 10) == [(5, 10, 0, 5), (10, 20, 5, 15), (20, 25, 15, 20)]
+    assert blocks(slice(0, 10), slice(3, 13), 10) == [(0, 10, 3, 13)]
+
+    ## Arrays are split where they aren't contiguous and at the chunk boundaries
+    assert blocks(np.array([0, 1, 2, 5, 6, 12]), slice(0, 6), 10) == [(0, 3, 0, 3), (5, 7, 3, 5), (12, 13, 5, 6)]
+    assert blocks(np.array([8, 9, 10, 11]), np.array([3, 2, 1, 0]), 10) == [(8, 9, 3, 4), (9, 10, 2, 3), (10, 11, 1, 2), (11, 12, 0, 1)]
+
+    ## Mixed slices and arrays
+    assert blocks(slice(8, 13), np.array([0, 2, 3, 4, 5]), 10) == [(8, 9, 0, 1), (9, 10, 2, 3), (10, 13, 3, 6)]
+    assert blocks(np.array([18, 19, 20, 25]), slice(4, 8), 10) == [(18, 20, 4, 6), (20, 21, 6, 7), (25, 26, 7, 8)]
+
+
+def test_ChunkPlan():
+    """
+
+    """
+    ## The local chunks are in the dims order of the input
+    plan = utils.ChunkPlan((10, 4), (slice(0, 15), slice(0, 4)), (slice(0, 15), slice(2, 6)), (1, 0), factor=1)
+
+    assert len(plan) == 2
+    assert plan.block_shape() == (10, 4)
+    assert list(plan) == [((slice(0, 10), slice(0, 4)), (slice(2, 6), slice(0, 10))), ((slice(10, 15), slice(0, 4)), (slice(2, 6), slice(10, 15)))]
+
+    plan = utils.ChunkPlan((2, 5), (np.array([0, 1, 3]), slice(0, 10)), (slice(0, 3), slice(0, 10)), (0, 1), factor=1)
 
+    assert len(plan) == 4
+    assert plan.block_shape() == (2, 5)
+    assert [global_chunk for global_chunk, local_chunk in plan][:3] == [(slice(0, 2), slice(0, 5)), (slice(0, 2), slice(5, 10)), (slice(3, 4), slice(0, 5))]
+    assert [local_chunk for global_chunk, local_chunk in plan][2] == (slice(2, 3), slice(0, 5))
 
+    plan = utils.ChunkPlan((2, 5), (np.array([0, 1, 3]), slice(0, 10)), (slice(0, 3), slice(0, 10)), (0, 1), factor=3)
 
+    assert len(plan) == 2
+    assert plan.block_shape() == (2, 10)
 
 
+def test_index_output_blocks():
+    """
+
+    """
+    data = {0: {'global_index': (slice(0, 8), slice(0, 10))}, 1: {'global_index': (slice(8, 20), slice(0, 10))}, 2: {'global_index': (np.array([1, 2, 19]), slice(4, 6))}}
+    var_dict = {'shape': (20, 10), 'data': data}
+
+    blocks = utils.index_output_blocks(var_dict, (2, 5))
+    assert not isinstance(blocks, list)
+
+    assert list(blocks) == [((slice(0, 6), slice(0, 10)), [0, 2]), ((slice(6, 12), slice(0, 10)), [0, 1, 2]), ((slice(12, 18), slice(0, 10)), [1, 2]), ((slice(18, 20), slice(0, 10)), [1, 2])]
+
+
+def test_H5_sel_prune_files():
+    """
+
+    """
+    ds_files = [f for f in files if '9568f663d566aabb62a8e98e' in f]
+    h1 = H5(ds_files)
+
+    time_slice = slice('2000-01-01', '2016-01-01')
+    h2 = h1.sel({'time': time_slice})
+
+    pruned = utils.prune_files(h2._manifests, h2._coords_dict)
+    assert list(pruned.values()) == [{'time'}]
+
+    for var_dict in h2._data_vars_dict.values():
+        if 'time' in var_dict['dims']:
+            assert len(var_dict['data']) == 1
+
+    x1 = h1.to_xarray().sel(time=time_slice).load()
+    x2 = h2.to_xarray().load()
+
+    assert x1.equals(x2)
+
+
+def test_filter_coords_sorted():
+    """
+
+    """
+    encodings = {'time': {'dtype': np.dtype('int64'), 'dtype_decoded': np.dtype('datetime64[s]'), 'units': 'hours since 2000-01-01 00:00:00', 'calendar': 'gregorian'}}
+    times = np.arange(0, 1000, 3, dtype='int64')
+    decoded = utils.decode_data(times, **encodings['time'])
+
+    for start, stop in [('2000-01-02', '2000-01-05T10:30'), (None, '2000-01-03T01'), ('2000-01-30', None), (None, None), ('2010-01-01', None), ('2000-01-05', '2000-01-02')]:
+        coords_dict = {'time': times}
+        utils.filter_coords(coords_dict, {'time': slice(start, stop)}, encodings)
+
+        mask = np.ones(len(times), dtype=bool)
+        if start is not None:
+            mask &= decoded >= np.datetime64(start, 's')
+        if stop is not None:
+            mask &= decoded < np.datetime64(stop, 's')
+
+        assert np.array_equal(coords_dict['time'], times[mask])
+
+
+def test_extend_coords_sorted():
+    """
+
+    """
+    sorted_data = np.array([1, 2, 5])
+    coords_dict = utils.extend_coords([{'coords': {'x': sorted_data, 'y': np.array([3, 1, 2])}}])
+
+    assert coords_dict['x'] is sorted_data
+    assert np.array_equal(coords_dict['y'], [1, 2, 3])
+
+    coords_dict = utils.extend_coords([{'coords': {'y': np.array([3, 1, 2])}}, {'coords': {'y': np.array([2, 0])}}])
+
+    assert np.array_equal(coords_dict['y'], [0, 1, 2, 3])
+
+
+def test_H5_sel_nearest_and_slices():
+    """
+
+    """
+    ds_files = [f for f in files if '0b2bd62cc42f3096136f11e9' in f]
+    h1 = H5(ds_files)
+    x1 = h1.to_xarray()
+    times = x1.time.values
+
+    ## Lists of slices
+    windows = [slice('2012-01-01', '2012-01-08'), slice('2020-03-01', '2020-03-02'), slice('2012-01-05', '2012-01-10')]
+    h2 = h1.sel({'time': windows})
+    mask = np.zeros(len(times), dtype=bool)
+    for w in windows:
+        mask |= (times >= np.datetime64(w.start)) & (times < np.datetime64(w.stop))
+
+    assert np.array_equal(h2.to_xarray().time.values, times[mask])
+
+    ## Nearest with tolerance
+    values = times[[5, 500, 1000]] + np.timedelta64(10, 'm')
+    h3 = h1.sel({'time': values}, method='nearest', tolerance=np.timedelta64(1, 'h'))
+    assert np.array_equal(h3.to_xarray().time.values, times[[5, 500, 1000]])
+
+    h4 = h1.sel({'time': values}, method='nearest', tolerance=60)
+    assert len(h4.to_xarray().time) == 0
+
+    with pytest.raises(ValueError):
+        h1.sel({'time': values}, method='pad')
+
+
+def test_H5_copy_sharing():
+    """
+
+    """
+    ds_files = [f for f in files if '0b2bd62cc42f3096136f11e9' in f]
+    h1 = H5(ds_files[:1])
+    x1 = h1.to_xarray().load()
+
+    h2 = h1.sel(include_data_vars=list(h1._data_vars_dict)[:1])
+    for coord, data in h2._coords_dict.items():
+        assert data is h1._coords_dict[coord]
+        assert not data.flags.writeable
+
+    ## Appending to a copy must not change the parent
+    h3 = h1.copy()
+    h3.append(ds_files[1:])
+
+    assert h1._files == ds_files[:1]
+    assert h1.to_xarray().load().equals(x1)
+    assert h3.to_xarray().load().equals(H5(ds_files).to_xarray().load())
+
+
+def test_H5_xr_inputs_writeable():
+    """
+
+    """
+    x1 = xr.open_dataset([f for f in files if '0b2bd62cc42f3096136f11e9' in f][0], engine='h5netcdf').load()
+    x1 = x1.assign_coords(station=('station', np.arange(3, dtype='int32')))
+    x1['count'] = ('station', np.arange(3, dtype='int16'))
+
+    h1 = H5(x1)
+    h1.to_hdf5(io.BytesIO())
+    h1.to_xarray().load()
+
+    for name, var in x1.variables.items():
+        assert var.values.flags.writeable, name
+
+    for coord, data in h1._coords_dict.items():
+        assert not data.flags.writeable
+
+
+def test_IndexTable():
+    """
+
+    """
+    irregular = np.array([0, 2, 5])
+    indexes = {
+        3: {'dims_order': (1, 0), 'global_index': [slice(10, 20), irregular], 'local_index': [slice(0, 10), slice(0, 3)]},
+        0: {'dims_order': (0, 1), 'global_index': [slice(0, 10), slice(0, 6)], 'local_index': [slice(0, 10), slice(0, 6)]},
+        7: {'dims_order': (0, 1), 'global_index': [slice(20, 25), slice(0, 6)], 'local_index': [slice(5, 10), slice(0, 6)]},
+        }
+
+    table = utils.IndexTable(2)
+    for i, index in indexes.items():
+        table[i] = index
+
+    assert list(table) == [0, 3, 7]
+    assert table[3]['global_index'][1] is irregular
+    for i, index in indexes.items():
+        assert table[i]['dims_order'] == index['dims_order']
+        assert table[i]['local_index'] == index['local_index']
+
+    c = table.copy()
+    del table[3]
+    table[7] = indexes[0]
+
+    assert list(table) == [0, 7]
+    assert 3 not in table
+    assert list(c) == [0, 3, 7]
+    assert c[7]['global_index'][0] == slice(20, 25)
+    assert table[7]['global_index'][0] == slice(0, 10)
+
+    with pytest.raises(KeyError):
+        table[3]
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_parallel_scan(ds_id):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+
+    manifests1 = utils.scan_files(ds_files)
+    manifests2 = utils.scan_files(ds_files, n_workers=2)
+
+    for m1, m2 in zip(manifests1, manifests2):
+        assert m1['data_vars'] == m2['data_vars']
+        assert m1['encodings'] == m2['encodings']
+        for coord, data in m1['coords'].items():
+            assert np.array_equal(data, m2['coords'][coord])
+
+    x1 = H5(ds_files).to_xarray().load()
+    x2 = H5(ds_files, n_workers=2).to_xarray().load()
+
+    assert x1.equals(x2)
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_access_profile(ds_id):
+    """
+
+    """
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+    x1 = h1.to_xarray().load()
+
+    h2 = H5(ds_files, access_profile={'rdcc_nbytes': 8*1024*1024, 'rdcc_w0': 1})
+    for access_profile in ['auto', {'rdcc_nbytes': 16*1024*1024, 'rdcc_nslots': 10007, 'meta_block_size': 1024*1024}]:
+        b1 = io.BytesIO()
+        h2.to_hdf5(b1, access_profile=access_profile)
+        x2 = xr.open_dataset(b1, engine='h5netcdf').load()
+
+        for var_name in x1.variables:
+            arr1 = x1[var_name].values
+            arr2 = x2[var_name].values
+            if arr1.dtype.kind == 'f':
+                assert np.allclose(arr1, arr2, equal_nan=True)
+            else:
+                assert np.array_equal(arr1.astype(str), arr2.astype(str))
+
+    with pytest.raises(ValueError):
+        h1.to_hdf5(io.BytesIO(), access_profile='fast')
+
+
+def test_chunk_cache_kwargs():
+    """
+
+    """
+    kwargs = utils.chunk_cache_kwargs((1, 1000), 8, (3, 3000))
+    assert kwargs['rdcc_nbytes'] == 1024*1024
+    assert kwargs['rdcc_w0'] == 1
+
+    kwargs = utils.chunk_cache_kwargs((10, 10000), 8, (30, 30001))
+    assert kwargs['rdcc_nbytes'] == 4*4*10*10000*8
+    assert kwargs['rdcc_nslots'] == utils.next_prime(kwargs['rdcc_nslots'])
+    assert kwargs['rdcc_nslots'] >= 100*16
+
+
+@pytest.mark.parametrize('units', ['hours since 1900-01-01', 'days since 1850-1-1 0:0:0', 'minutes since 1990-05-05 12:30:00', 'milliseconds since 2001-01-01T00:00:00Z'])
+def test_datetime_numpy_path(units):
+    """
+
+    """
+    import cftime
+
+    assert utils.parse_time_units(units) is not None
+
+    nums = np.arange(-5000, 200000, 37)
+    dates = utils.decode_datetime(nums, units, 'gregorian')
+    assert np.array_equal(dates, cftime.num2pydate(nums, units, 'gregorian').astype('datetime64[s]'))
+
+    nums_float = nums + 0.25
+    dates_float = utils.decode_datetime(nums_float, units, 'gregorian')
+    assert np.array_equal(dates_float, cftime.num2pydate(nums_float, units, 'gregorian').astype('datetime64[s]'))
+
+    for d in (dates, dates_float):
+        encoded = utils.encode_datetime(d, units, 'gregorian')
+        assert np.array_equal(np.asarray(encoded).astype('int64'), np.asarray(cftime.date2num(d.tolist(), units, 'gregorian')).astype('int64'))
+
+    assert np.array_equal(utils.decode_datetime(utils.encode_datetime(dates, units, 'gregorian'), units, 'gregorian'), dates)
+
+    ## NaT
+    encoded = utils.encode_datetime(np.array(['NaT'], dtype='datetime64[s]'), units, 'gregorian')
+    assert utils.decode_datetime(encoded, units, 'gregorian')[0] != utils.decode_datetime(encoded, units, 'gregorian')[0]
+
+
+@pytest.mark.parametrize('dtype_decoded', ['float32', 'float64'])
+def test_scale_codec_in_place(dtype_decoded):
+    """
+
+    """
+    encoding = {'dtype': np.dtype('int16'), 'dtype_decoded': np.dtype(dtype_decoded), 'missing_value': -9999, 'add_offset': 12.5, 'scale_factor': 0.01}
+
+    data = (np.random.default_rng(1).random((70, 1000)) * 600 - 300).astype(dtype_decoded)
+    data[3, 5:50] = np.nan
+
+    ## Same result as the full-size expressions
+    expected = np.round((data - encoding['add_offset'])/encoding['scale_factor'])
+    expected[np.isnan(expected)] = encoding['missing_value']
+    expected = expected.astype('int16')
+
+    encoded = utils.encode_data(data, **encoding)
+    assert encoded.dtype == np.dtype('int16')
+    assert np.array_equal(encoded, expected)
+
+    expected_decoded = expected.astype(dtype_decoded)
+    expected_decoded[expected == encoding['missing_value']] = np.nan
+    expected_decoded = (expected_decoded * encoding['scale_factor']) + encoding['add_offset']
+
+    decoded = utils.decode_data(encoded, **encoding)
+    assert decoded.dtype == np.dtype(dtype_decoded)
+    assert np.array_equal(decoded, expected_decoded, equal_nan=True)
+
+    ## Preallocated outputs
+    out = np.empty(data.shape, dtype='int16')
+    assert utils.encode_data(data[:, ::-1], out=out, **encoding) is out
+    assert np.array_equal(out, expected[:, ::-1])
+
+    out = np.empty(data.shape, dtype=dtype_decoded)
+    assert utils.decode_data(encoded, out=out, **encoding) is out
+    assert np.array_equal(out, expected_decoded, equal_nan=True)
+
+    ## Non-contiguous outputs
+    out = np.zeros((data.shape[1], data.shape[0]), dtype='int16').T
+    assert not out.flags.c_contiguous
+    assert utils.encode_data(data, out=out, **encoding) is out
+    assert np.array_equal(out, expected)
+
+    out_base = np.zeros((data.shape[0], data.shape[1]*2), dtype='int16')
+    utils.encode_data(data, out=out_base[:, ::2], **encoding)
+    assert np.array_equal(out_base[:, ::2], expected)
+    assert not out_base[:, 1::2].any()
+
+    out = np.empty((data.shape[1], data.shape[0]), dtype=dtype_decoded).T
+    assert utils.decode_data(encoded, out=out, **encoding) is out
+    assert np.array_equal(out, expected_decoded, equal_nan=True)
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_codecs(ds_id):
+    """
+
+    """
+    import h5py
+
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+    x1 = h1.to_xarray().load()
+
+    ## delta on the time coordinate
+    b1 = io.BytesIO()
+    h1.to_hdf5(b1, codecs={'time': ['delta']})
+    with h5py.File(b1, 'r') as f:
+        assert utils.parse_codecs(f['time'].attrs['codecs']) == [{'id': 'delta'}]
+        stored = f['time'][:]
+    assert np.array_equal(np.cumsum(stored), h1._coords_dict['time'])
+
+    h2 = H5(b1)
+    assert h2.to_xarray().load().equals(x1)
+
+    # The codecs are kept, unless they are replaced
+    mid_time = x1.time.values[len(x1.time)//2]
+    b2 = io.BytesIO()
+    h2.sel({'time': slice(None, mid_time)}).to_hdf5(b2, unlimited_dims='time')
+    h2.sel({'time': slice(mid_time, None)}).to_hdf5(b2, mode='a', codecs={'time': []})
+    with h5py.File(b2, 'r') as f:
+        assert 'codecs' in f['time'].attrs
+    assert H5(b2).to_xarray().load().equals(x1)
+
+    b3 = io.BytesIO()
+    h2.to_hdf5(b3, codecs={'time': []})
+    with h5py.File(b3, 'r') as f:
+        assert 'codecs' not in f['time'].attrs
+        assert np.array_equal(f['time'][:], h1._coords_dict['time'])
+
+    ## bitround on float data that are scaled to ints in the inputs
+    scaled = [v for v in h1._data_vars_dict if ('scale_factor' in h1._encodings[v]) and (h1._encodings[v]['dtype_decoded'] == np.dtype('float32'))]
+    bitround = {v: [{'id': 'bitround', 'keepbits': 23}] for v in scaled}
+    b4 = io.BytesIO()
+    h1.to_hdf5(b4, codecs=bitround)
+    with h5py.File(b4, 'r') as f:
+        for v in scaled:
+            assert f[v].dtype == np.dtype('float32')
+            assert 'scale_factor' not in f[v].attrs
+    assert H5(b4).to_xarray().load().equals(x1)
+
+    # Appends to the float datasets are decoded too
+    b5 = io.BytesIO()
+    h1.sel({'time': slice(None, mid_time)}).to_hdf5(b5, unlimited_dims='time', codecs=bitround)
+    h1.sel({'time': slice(mid_time, None)}).to_hdf5(b5, mode='a')
+    assert H5(b5).to_xarray().load().equals(x1)
+
+    ## Bad codecs
+    var_name = list(h1._data_vars_dict)[0]
+    with pytest.raises(ValueError):
+        h1.to_hdf5(io.BytesIO(), codecs={'time': ['zfp']})
+    with pytest.raises(TypeError):
+        h1.to_hdf5(io.BytesIO(), codecs={'time': [{'id': 'bitround', 'keepbits': 10}]})
+    if np.dtype(h1._encodings[var_name]['dtype']).kind in 'iu':
+        with pytest.raises(ValueError):
+            h1.to_hdf5(io.BytesIO(), codecs={var_name: ['delta']})
+
+
+def test_bitround_codec():
+    """
+
+    """
+    rng = np.random.default_rng(2)
+    data = rng.normal(15, 5, (200, 300)).astype('float32')
+    data[0, :10] = np.nan
+
+    rounded = utils.bitround(data, 7)
+    assert np.array_equal(np.isnan(rounded), np.isnan(data))
+    assert np.allclose(rounded, data, rtol=2**-7, equal_nan=True)
+    assert np.all(rounded[~np.isnan(rounded)].view('uint32') & ((1 << 16) - 1) == 0)
+    assert np.array_equal(utils.bitround(data, 23), data, equal_nan=True)
+
+    x1 = xr.Dataset({'temp': (('y', 'x'), data)}, coords={'y': np.arange(200, dtype='int32'), 'x': np.arange(300, dtype='int32')})
+    x1['temp'].encoding = {'codecs': [{'id': 'bitround', 'keepbits': 7}]}
+
+    b1 = io.BytesIO()
+    H5(x1).to_hdf5(b1)
+    x2 = H5(b1).to_xarray().load()
+    assert x2['temp'].dtype == np.dtype('float32')
+    assert np.array_equal(x2['temp'].values, rounded, equal_nan=True)
+
+    # Lossless copy without bitround
+    b2 = io.BytesIO()
+    x1['temp'].encoding = {'codecs': []}
+    H5(x1).to_hdf5(b2)
+    assert len(b1.getvalue()) < len(b2.getvalue())
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_string_storage(ds_id):
+    """
+
+    """
+    import h5py
+
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+    x1 = h1.to_xarray().load()
+
+    assert h1._coords_dict['geometry'].dtype.kind == 'U'
+
+    for storage in ['fixed', 'categorical']:
+        b1 = io.BytesIO()
+        h1.to_hdf5(b1, strings=storage)
+        with h5py.File(b1, 'r') as f:
+            if storage == 'fixed':
+                assert f['geometry'].dtype.kind == 'S'
+                assert f['geometry'].attrs['_Encoding'] == 'utf-8'
+            else:
+                assert f['geometry'].dtype.kind == 'i'
+                assert 'categories' in f['geometry'].attrs
+
+        h2 = H5(b1)
+        assert np.array_equal(h2._coords_dict['geometry'], h1._coords_dict['geometry'])
+        assert h2.to_xarray().load().equals(x1)
+
+        # The storage is kept
+        b2 = io.BytesIO()
+        h2.to_hdf5(b2)
+        with h5py.File(b2, 'r') as f:
+            assert f['geometry'].dtype.kind == ('S' if storage == 'fixed' else 'i')
+
+        if storage == 'fixed':
+            x2 = xr.open_dataset(b1, engine='h5netcdf').load()
+            assert np.array_equal(x2['geometry'].values.astype(str), x1['geometry'].values.astype(str))
+
+    ## Appending new strings
+    geo = h1._coords_dict['geometry']
+    if len(geo) > 1:
+        mid = geo[len(geo)//2]
+        for storage in ['vlen', 'categorical']:
+            b3 = io.BytesIO()
+            h1.sel({'geometry': geo[geo < mid]}).to_hdf5(b3, unlimited_dims='geometry', strings=storage)
+            h1.sel({'geometry': geo[geo >= mid]}).to_hdf5(b3, mode='a')
+            assert H5(b3).to_xarray().load().equals(x1)
+
+    with pytest.raises(ValueError):
+        h1.to_hdf5(io.BytesIO(), strings={'time': 'fixed'})
+    with pytest.raises(ValueError):
+        h1.to_hdf5(io.BytesIO(), strings='zipped')
+
+
+def test_guess_chunk_strategy():
+    """
+
+    """
+    dtype = np.dtype('int16')
+    shape = (87600, 2000)
+    dims = ('time', 'station')
+
+    assert utils.guess_chunk(shape, shape, dtype, utils.chunk_weights(dims, None)) == utils.guess_chunk(shape, shape, dtype)
+
+    for strategy in ['timeseries', 'spatial', 'balanced', {'time': 4}, 64*1024]:
+        chunks = utils.guess_chunk(shape, shape, dtype, utils.chunk_weights(dims, strategy), strategy if isinstance(strategy, int) else None)
+        assert np.prod(chunks) * dtype.itemsize <= utils.CHUNK_MAX
+
+    assert utils.guess_chunk(shape, shape, dtype, utils.chunk_weights(dims, 'timeseries'))[0] == shape[0]
+    assert utils.guess_chunk(shape, shape, dtype, utils.chunk_weights(dims, 'spatial'))[1] == shape[1]
+    chunks = utils.guess_chunk(shape, shape, dtype, utils.chunk_weights(dims, {'time': 4}))
+    assert chunks[0] // chunks[1] in (4, 5, 6)
+    assert np.prod(utils.guess_chunk(shape, shape, dtype, None, 64*1024)) * 2 < 64*1024*1.5
+
+    with pytest.raises(ValueError):
+        utils.chunk_weights(dims, 'station')
+
+    for strategy in [0, -1024, True, False]:
+        with pytest.raises(ValueError):
+            utils.chunk_weights(dims, strategy)
+
+
+@pytest.mark.parametrize('ds_id', ds_ids)
+def test_H5_chunk_strategy(ds_id):
+    """
+
+    """
+    import h5py
+
+    ds_files = [f for f in files if ds_id in f]
+    h1 = H5(ds_files)
+    x1 = h1.to_xarray().load()
+
+    var_name = [v for v, d in h1._data_vars_dict.items() if 'time' in d['dims']][0]
+
+    for strategy in ['timeseries', 'spatial']:
+        b1 = io.BytesIO()
+        h1.to_hdf5(b1, chunk_strategy=strategy)
+        with h5py.File(b1, 'r') as f:
+            ds = f[var_name]
+            time_axis = [dim.label for dim in ds.dims].index('time')
+            if strategy == 'timeseries':
+                assert ds.chunks[time_axis] == ds.shape[time_axis]
+            else:
+                assert all(c == s for i, (c, s) in enumerate(zip(ds.chunks, ds.shape)) if i != time_axis)
+        assert H5(b1).to_xarray().load().equals(x1)
+
+    with pytest.raises(ValueError):
+        h1.to_hdf5(io.BytesIO(), chunk_strategy='fast')
 
+    for strategy in [0, -1, True]:
+        with pytest.raises(ValueError):
+            h1.to_hdf5(io.BytesIO(), chunk_strategy=strategy)
@@ -6,6 +6,8 @@ Created on Fri Sep 30 19:52:08 2022
 @author: mike
 """
 import io
+import re
+import json
 import pathlib
 import h5py
 import os
@@ -17,6 +19,12 @@ import cftime
 # import dateutil.parser as dparser
 # import numcodecs
 import hdf5plugin
+import concurrent.futures
+import itertools
+import functools
+import shelve
+from collections import deque
+from collections.abc import MutableMapping
 
 
 ########################################################
@@ -26,6 +34,7 @@ import hdf5plugin
 CHUNK_BASE = 32*1024    # Multiplier by which chunks are adjusted
 CHUNK_MIN = 32*1024      # Soft lower limit (32k)
 CHUNK_MAX = 3*1024*1024   # Hard upper limit (4M)
+CHUNK_CACHE_MAX = 256*1024*1024   # Upper limit of the chunk cache of a single dataset
 
 time_str_conversion = {'days': 'datetime64[D]',
                        'hours': 'datetime64[h]',
@@ -33,7 +42,22 @@ time_str_conversion = {'days': 'datetime64[D]',
                        'seconds': 'datetime64[s]',
                        'milliseconds': 'datetime64[ms]'}
 
-enc_fields = ('units', 'calendar', 'dtype', 'missing_value', '_FillValue', 'add_offset', 'scale_factor')
+time_unit_codes = {'days': 'D', 'day': 'D', 'd': 'D',
+                   'hours': 'h', 'hour': 'h', 'hrs': 'h', 'hr': 'h', 'h': 'h',
+                   'minutes': 'm', 'minute': 'm', 'mins': 'm', 'min': 'm',
+                   'seconds': 's', 'second': 's', 'secs': 's', 'sec': 's', 's': 's',
+                   'milliseconds': 'ms', 'millisecond': 'ms', 'msecs': 'ms', 'msec': 'ms', 'ms': 'ms',
+                   'microseconds': 'us', 'microsecond': 'us', 'usecs': 'us', 'usec': 'us', 'us': 'us'}
+
+numpy_calendars = ('standard', 'gregorian', 'proleptic_gregorian')
+
+gregorian_start = np.datetime64('1582-10-15', 's')
+
+enc_fields = ('units', 'calendar', 'dtype', 'missing_value', '_FillValue', 'add_offset', 'scale_factor', 'codecs', '_Encoding', 'categories')
+
+nc_internal_attrs = ('_NCProperties', '_IsNetcdf4', '_SuperblockVersion', '_Format', '_nc3_strict', '_Netcdf4Coordinates', '_Netcdf4Dimid')
+
+string_storages = ('vlen', 'fixed', 'categorical')
 
 missing_value_dict = {'int8': -128, 'int16': -32768, 'int32': -2147483648, 'int64': -9223372036854775808}
 
@@ -41,9 +65,71 @@ missing_value_dict = {'int8': -128, 'int16': -32768, 'int32': -2147483648, 'int6
 ### Functions
 
 
-def encode_datetime(data, units=None, calendar='gregorian'):
+def parse_time_units(units, calendar='gregorian'):
     """
+    Parse CF time units of the form "<unit> since <ISO date>" for the numpy datetime path. Returns a tuple of the numpy unit code, the origin as a np.datetime64, and the numpy resolution code of the calculations (the unit or seconds, whichever is finer). Returns None if the units or calendar can't be handled by numpy (which means cftime needs to be used).
+    """
+    if calendar not in numpy_calendars:
+        return None
+
+    parts = units.strip().split(' since ')
+    if len(parts) != 2:
+        return None
+
+    unit = time_unit_codes.get(parts[0].strip().lower())
+    if unit is None:
+        return None
+
+    origin_str = parts[1].strip()
+    for suffix in (' UTC', 'UTC', 'Z', '+00:00', '+0000'):
+        if origin_str.endswith(suffix):
+            origin_str = origin_str[:-len(suffix)].strip()
+            break
+
+    ## CF dates don't need to be zero padded (e.g. 1900-1-1 0:0:0)
+    match = re.fullmatch(r'(\d{1,4})-(\d{1,2})-(\d{1,2})(?:[ T](\d{1,2}):(\d{1,2})(?::(\d{1,2})(\.\d+)?)?)?', origin_str)
+    if match is None:
+        return None
+
+    year, month, day, hour, minute, second, fraction = match.groups()
+    origin_str = '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}{}'.format(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0), fraction or '')
+
+    try:
+        origin = np.datetime64(origin_str)
+    except ValueError:
+        return None
+
+    if unit in ('ms', 'us'):
+        res = unit
+    else:
+        res = 's'
+
+    ## The origin must be representable in the resolution of the calculations
+    if origin.astype('datetime64[' + res + ']') != origin:
+        return None
+    origin = origin.astype('datetime64[' + res + ']')
 
+    if (calendar != 'proleptic_gregorian') and (origin < gregorian_start):
+        return None
+
+    return unit, origin, res
+
+
+def is_gregorian(dates, calendar):
+    """
+    Check that the (non NaT) dates don't need the julian part of the standard/gregorian calendar.
+    """
+    if calendar == 'proleptic_gregorian':
+        return True
+
+    valid = dates[~np.isnat(dates)]
+
+    return (len(valid) == 0) or (valid.min() >= gregorian_start)
+
+
+def encode_datetime(data, units=None, calendar='gregorian'):
+    """
+    Encode datetimes to numbers of units since an origin. Units since 1970-01-01 are a simple numpy cast and other "<unit> since <ISO date>" units of the standard/gregorian/proleptic_gregorian calendars are calculated with int64 numpy arithmetic. Other units and calendars use cftime. NaTs are encoded as the int64 minimum (or NaN if the numbers are not whole units).
     """
     if units is None:
         output = data.astype('datetime64[s]').astype('int64')
@@ -52,14 +138,30 @@ def encode_datetime(data, units=None, calendar='gregorian'):
             time_unit = units.split()[0]
             output = data.astype(time_str_conversion[time_unit]).astype('int64')
         else:
-            output = cftime.date2num(data.astype('datetime64[s]').tolist(), units, calendar)
+            parsed = parse_time_units(units, calendar)
+            dates = data.astype('datetime64[s]')
+
+            if (parsed is not None) and is_gregorian(dates, calendar):
+                unit, origin, res = parsed
+                nat = np.isnat(dates)
+                delta = (dates.astype('datetime64[' + res + ']') - origin).astype('int64')
+                unit_n = np.timedelta64(1, unit).astype('timedelta64[' + res + ']').astype('int64')
+
+                if np.all(delta[~nat] % unit_n == 0):
+                    output = delta // unit_n
+                    output[nat] = missing_value_dict['int64']
+                else:
+                    output = delta / unit_n
+                    output[nat] = np.nan
+            else:
+                output = cftime.date2num(dates.tolist(), units, calendar)
 
     return output
 
 
 def decode_datetime(data, units=None, calendar='gregorian'):
     """
-
+    Decode numbers of units since an origin to datetime64[s] (the inverse of encode_datetime). The int64 minimum and NaN are decoded as NaT on the numpy paths.
     """
     if units is None:
         output = data.astype('datetime64[s]')
@@ -68,24 +170,94 @@ def decode_datetime(data, units=None, calendar='gregorian'):
             time_unit = units.split()[0]
             output = data.astype(time_str_conversion[time_unit])
         else:
-            output = cftime.num2pydate(data, units, calendar).astype('datetime64[s]')
+            parsed = parse_time_units(units, calendar)
+            output = None
+
+            if parsed is not None:
+                unit, origin, res = parsed
+
+                if data.dtype.kind in 'iu':
+                    nat = data == missing_value_dict['int64']
+                    delta = data.astype('int64').astype('timedelta64[' + unit + ']').astype('timedelta64[' + res + ']')
+                    output = (origin + delta).astype('datetime64[s]')
+                else:
+                    ## Like cftime, round to microseconds before truncating to seconds
+                    nat = np.isnan(data)
+                    unit_us = np.timedelta64(1, unit).astype('timedelta64[us]').astype('int64')
+                    delta_us = np.round(np.where(nat, 0, data) * unit_us).astype('int64').astype('timedelta64[us]')
+                    output = (origin.astype('datetime64[us]') + delta_us).astype('datetime64[s]')
+
+                output[nat] = np.datetime64('NaT')
+
+                if not is_gregorian(output, calendar):
+                    output = None
+
+            if output is None:
+                output = cftime.num2pydate(data, units, calendar).astype('datetime64[s]')
 
     return output
 
 
-def encode_data(data, dtype, missing_value=None, add_offset=0, scale_factor=None, units=None, calendar=None, **kwargs):
+def scale_encode(data, out, add_offset=0, scale_factor=1, missing_value=None, block_size=65536):
+    """
+    Write round((data - add_offset)/scale_factor) into out with NaNs set to the missing_value. It's done in blocks through one small float buffer so that no full-size temporaries are created. Non-contiguous data and outputs (e.g. views) are read and written through their flat iterators in C order.
     """
+    data = np.asarray(data)
+    if out.shape != data.shape:
+        raise ValueError('out must have the same shape as the data.')
 
+    calc_dtype = np.result_type(data, add_offset, scale_factor)
+    if calc_dtype.kind != 'f':
+        calc_dtype = np.dtype('float64')
+
+    fill_nan = isinstance(missing_value, (int, np.number))
+
+    # reshape would silently copy non-contiguous arrays (and the output would never be written)
+    if data.flags.c_contiguous:
+        flat_data = data.reshape(-1)
+    else:
+        flat_data = data.flat
+
+    if out.flags.c_contiguous:
+        flat_out = out.reshape(-1)
+    else:
+        flat_out = out.flat
+
+    n = data.size
+
+    buffer = np.empty(min(block_size, n), dtype=calc_dtype)
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        b = buffer[:stop - start]
+        np.subtract(flat_data[start:stop], add_offset, out=b, casting='unsafe')
+        np.divide(b, scale_factor, out=b, casting='unsafe')
+        np.round(b, out=b)
+
+        if fill_nan:
+            b[np.isnan(b)] = missing_value
+
+        flat_out[start:stop] = b
+
+    return out
+
+
+def encode_data(data, dtype, missing_value=None, add_offset=0, scale_factor=None, units=None, calendar=None, out=None, **kwargs):
+    """
+    Encode data with an encoding. If out is passed, the encoded data are written into it (it must have the data shape and the encoded dtype).
     """
     if 'datetime64' in data.dtype.name:
         data = encode_datetime(data, units, calendar)
 
     elif isinstance(scale_factor, (int, float, np.number)):
         # precision = int(np.abs(np.log10(val['scale_factor'])))
-        data = np.round((data - add_offset)/scale_factor)
+        if out is None:
+            out = np.empty(data.shape, dtype=dtype)
 
-        if isinstance(missing_value, (int, np.number)):
-            data[np.isnan(data)] = missing_value
+        return scale_encode(data, out, add_offset, scale_factor, missing_value)
+
+    if out is not None:
+        out[...] = data
+        return out
 
     if (data.dtype != dtype) or (data.dtype.name == 'object'):
         data = data.astype(dtype)
@@ -93,39 +265,258 @@ def encode_data(data, dtype, missing_value=None, add_offset=0, scale_factor=None
     return data
 
 
-def decode_data(data, dtype_decoded, missing_value=None, add_offset=0, scale_factor=None, units=None, calendar=None, **kwargs):
+def decode_data(data, dtype_decoded, missing_value=None, add_offset=0, scale_factor=None, units=None, calendar=None, out=None, **kwargs):
     """
-
+    Decode data with an encoding. If out is passed, the decoded data are written into it (it must have the data shape and the decoded dtype). Scaled data are decoded in place in the output.
     """
     if isinstance(calendar, str):
         data = decode_datetime(data, units, calendar)
 
     elif isinstance(scale_factor, (int, float, np.number)):
-        data = data.astype(dtype_decoded)
+        if out is None:
+            out = np.empty(data.shape, dtype=dtype_decoded)
+
+        out[...] = data
 
         if isinstance(missing_value, (int, np.number)):
-            data[data == missing_value] = np.nan
+            out[data == missing_value] = np.nan
+
+        np.multiply(out, scale_factor, out=out, casting='unsafe')
+        np.add(out, add_offset, out=out, casting='unsafe')
 
-        data = (data * scale_factor) + add_offset
+        return out
 
     # elif (data.dtype.name == 'object'):
     #     data = data.astype(str).astype(dtype_decoded)
 
-    elif (data.dtype != dtype_decoded) or (data.dtype.name == 'object'):
+    elif (out is None) and ((data.dtype != dtype_decoded) or (data.dtype.name == 'object')):
         data = data.astype(dtype_decoded)
 
+    if out is not None:
+        out[...] = data
+        return out
+
+    return data
+
+
+def bitround(data, keepbits):
+    """
+    Round the mantissas of float data to keepbits bits (round to nearest, ties to even). The trailing zero bits compress much better, but the codec is lossy.
+    """
+    mbits = np.finfo(data.dtype).nmant
+    if keepbits >= mbits:
+        return data
+
+    if keepbits < 0:
+        raise ValueError('keepbits must be >= 0.')
+
+    uint = np.dtype('uint' + str(data.dtype.itemsize * 8))
+    maskbits = mbits - keepbits
+    mask = np.array(((1 << (data.dtype.itemsize * 8)) - 1) >> maskbits << maskbits, dtype=uint)
+    half = np.array((1 << (maskbits - 1)) - 1, dtype=uint)
+
+    output = np.array(data, copy=True)
+    bits = output.view(uint)
+    bits += ((bits >> uint.type(maskbits)) & uint.type(1)) + half
+    bits &= mask
+
+    nan_bool = np.isnan(data)
+    if nan_bool.any():
+        output[nan_bool] = np.nan
+
+    return output
+
+
+def bitround_decode(data, keepbits):
+    """
+
+    """
+    return data
+
+
+def delta_encode(data):
+    """
+    The first value followed by the differences between consecutive values (of a 1D integer array).
+    """
+    output = np.empty_like(data)
+    output[:1] = data[:1]
+    np.subtract(data[1:], data[:-1], out=output[1:])
+
+    return output
+
+
+def delta_decode(data):
+    """
+
+    """
+    return np.cumsum(data, dtype=data.dtype)
+
+
+codec_registry = {}
+
+
+def register_codec(name, encode, decode, kinds='biuf', chunked=True):
+    """
+    Register a codec that can be chained in the codecs encoding of a dataset. encode and decode are functions that take the data and the (JSON serializable) parameters of the codec as keyword arguments and return the new data. kinds are the numpy dtype kinds of the stored data that the codec supports. If chunked is False, then the codec needs the whole array and can only be used on coordinates.
+    """
+    codec_registry[name] = {'encode': encode, 'decode': decode, 'kinds': kinds, 'chunked': chunked}
+
+
+register_codec('bitround', bitround, bitround_decode, 'f')
+register_codec('delta', delta_encode, delta_decode, 'iu', False)
+
+
+def parse_codecs(codecs):
+    """
+    Parse the codecs of an encoding into a list of dicts with the codec name as 'id' and the parameters. codecs can be a JSON str (as stored in the dataset attrs), a codec name, a dict, or a list of names/dicts.
+    """
+    if isinstance(codecs, bytes):
+        codecs = codecs.decode()
+    if isinstance(codecs, str):
+        if codecs.startswith('['):
+            codecs = json.loads(codecs)
+        else:
+            codecs = [codecs]
+    elif isinstance(codecs, dict):
+        codecs = [codecs]
+
+    output = []
+    for codec in codecs:
+        if isinstance(codec, str):
+            codec = {'id': codec}
+        else:
+            codec = dict(codec)
+
+        if codec.get('id') not in codec_registry:
+            raise ValueError(str(codec.get('id')) + ' is not a registered codec. It must be one of: ' + str(list(codec_registry)))
+
+        output.append(codec)
+
+    return output
+
+
+def check_codecs(codecs, dtype, coord=False):
+    """
+    Check that the codecs can be used on a dataset with the stored dtype.
+    """
+    for codec in codecs:
+        reg = codec_registry[codec['id']]
+        if np.dtype(dtype).kind not in reg['kinds']:
+            raise TypeError('The ' + codec['id'] + ' codec does not support the stored dtype ' + str(dtype) + '.')
+        if not (reg['chunked'] or coord):
+            raise ValueError('The ' + codec['id'] + ' codec needs the whole array, so it can only be used on coordinates.')
+
+
+def encode_codecs(data, codecs):
+    """
+    Apply a chain of codecs to the (encoded) data before it is stored.
+    """
+    for codec in codecs:
+        params = {k: v for k, v in codec.items() if k != 'id'}
+        data = codec_registry[codec['id']]['encode'](data, **params)
+
+    return data
+
+
+def decode_codecs(data, codecs):
+    """
+    Undo a chain of codecs on stored data (in reverse order).
+    """
+    for codec in reversed(codecs):
+        params = {k: v for k, v in codec.items() if k != 'id'}
+        data = codec_registry[codec['id']]['decode'](data, **params)
+
     return data
 
 
-def get_encoding(data):
+def string_storage(encoding):
+    """
+    The storage of string data from its encoding (see string_storages).
+    """
+    if 'categories' in encoding:
+        return 'categorical'
+    elif '_Encoding' in encoding:
+        return 'fixed'
+    else:
+        return 'vlen'
+
+
+def string_storage_encoding(data, storage):
+    """
+    The stored dtype and the extra encoding fields to store the string data (a numpy unicode array) as variable length strings ('vlen'), fixed width utf-8 bytes ('fixed'), or integer codes of a lookup table of the categories ('categorical').
+    """
+    if storage == 'fixed':
+        width = max(np.char.encode(data, 'utf-8').dtype.itemsize, 1)
+        return {'dtype': h5py.string_dtype('utf-8', width), '_Encoding': 'utf-8'}
+    elif storage == 'categorical':
+        categories = np.unique(data)
+        for dtype in (np.dtype('int8'), np.dtype('int16'), np.dtype('int32')):
+            if len(categories) <= np.iinfo(dtype).max + 1:
+                break
+        return {'dtype': dtype, 'categories': categories.tolist()}
+    elif storage == 'vlen':
+        return {'dtype': h5py.string_dtype()}
+    else:
+        raise ValueError('The string storage must be one of ' + str(string_storages) + '.')
+
+
+def encode_strings(data, encoding, dtype=None):
     """
+    Convert string data (a numpy unicode array) to the storage of the encoding. If the stored dtype of an existing dataset is passed, then an error is raised if the data don't fit in it.
+    """
+    if 'categories' in encoding:
+        categories = np.asarray(encoding['categories'], dtype=str)
+        codes = np.searchsorted(categories, data)
+        if len(categories) and not np.array_equal(categories[np.minimum(codes, len(categories) - 1)], data):
+            raise ValueError('The string data have values that are not in the categories.')
+        if dtype is None:
+            dtype = string_storage_encoding(categories, 'categorical')['dtype']
+        elif len(categories) > np.iinfo(dtype).max + 1:
+            raise ValueError('There are too many categories for the stored ' + dtype.name + ' codes.')
+        output = codes.astype(dtype)
+    elif '_Encoding' in encoding:
+        output = np.char.encode(data, encoding['_Encoding'])
+        if dtype is None:
+            dtype = h5py.string_dtype(encoding['_Encoding'], max(output.dtype.itemsize, 1))
+        elif output.dtype.itemsize > dtype.itemsize:
+            raise ValueError('The string data are wider than the fixed width of the stored strings.')
+        output = output.astype(dtype)
+    else:
+        output = data.astype(h5py.string_dtype())
+
+    return output
+
 
+def decode_strings(data, encoding):
+    """
+    Convert stored string data (variable length, fixed width bytes, or categorical codes) to a numpy unicode array.
+    """
+    if 'categories' in encoding:
+        data = np.asarray(encoding['categories'], dtype=str)[data]
+    elif data.dtype.kind == 'S':
+        try:
+            # Vectorised when the strings are ascii
+            data = data.astype(str)
+        except UnicodeDecodeError:
+            data = np.char.decode(data, encoding.get('_Encoding', 'utf-8'))
+    else:
+        data = data.astype(str)
+
+    return data
+
+
+def get_encoding(data, attrs=None):
+    """
+    The encoding of an xr.DataArray or h5py dataset. The attrs of an h5py dataset can be passed if they have already been read.
     """
     if isinstance(data, xr.DataArray):
         encoding = {f: v for f, v in data.encoding.items() if f in enc_fields}
     else:
+        if attrs is None:
+            attrs = data.attrs
+
         encoding = {}
-        for f, v in data.attrs.items():
+        for f, v in attrs.items():
             if f in enc_fields:
                 if isinstance(v, bytes):
                     encoding[f] = v.decode()
@@ -137,7 +528,13 @@ def get_encoding(data):
                 else:
                     encoding[f] = v
 
-    if (data.dtype.name == 'object') or ('str' in data.dtype.name):
+    if 'categories' in encoding:
+        if isinstance(encoding['categories'], str):
+            encoding['categories'] = json.loads(encoding['categories'])
+        encoding['dtype'] = h5py.string_dtype()
+    elif (data.dtype.name == 'object') or ('str' in data.dtype.name):
+        encoding['dtype'] = h5py.string_dtype()
+    elif isinstance(data, h5py.Dataset) and (h5py.check_string_dtype(data.dtype) is not None): # Fixed width strings
         encoding['dtype'] = h5py.string_dtype()
     elif ('datetime64' in data.dtype.name): # which means it's an xr.DataArray
         encoding['dtype'] = np.dtype('int64')
@@ -153,8 +550,11 @@ def get_encoding(data):
         encoding['missing_value'] = missing_value_dict['int64']
         encoding['_FillValue'] = encoding['missing_value']
 
+    if 'codecs' in encoding:
+        encoding['codecs'] = parse_codecs(encoding['codecs'])
+
     if 'dtype' not in encoding:
-        if np.issubdtype(data.dtype, np.floating):
+        if np.issubdtype(data.dtype, np.floating) and ('codecs' not in encoding):
             raise ValueError('float dtypes must have encoding data to encode to int.')
         encoding['dtype'] = data.dtype
     elif isinstance(encoding['dtype'], str):
@@ -202,66 +602,38 @@ def assign_dtype_decoded(encoding):
     return encoding
 
 
-def get_encodings(files):
+def float_encoding(encoding):
     """
-    I should add checking across the files for conflicts at some point.
+    The encoding of a float data variable that is stored as its decoded float dtype rather than scaled to ints (e.g. so that float codecs like bitround can be used on it). The scaling fields are dropped.
     """
-    # file_encs = {}
-    encs = {}
-    for i, file in enumerate(files):
-        # file_encs[i] = {}
-        if isinstance(file, xr.Dataset):
-            ds_list = list(file.variables)
-        else:
-            ds_list = list(file.keys())
+    encoding = {f: v for f, v in encoding.items() if f not in ('scale_factor', 'add_offset', 'missing_value', '_FillValue')}
+    encoding['dtype'] = encoding['dtype_decoded']
 
-        for name in ds_list:
-            enc = get_encoding(file[name])
-            enc = assign_dtype_decoded(enc)
-            # file_encs[i].update({name: enc})
-
-            if name in encs:
-                encs[name].update(enc)
-            else:
-                encs[name] = enc
-
-        for name, enc in encs.items():
-            enc = assign_dtype_decoded(enc)
-            encs[name] = enc
-
-    return encs
+    return encoding
 
 
-def get_attrs(files):
+def filter_attrs(attrs):
     """
-
+    Remove the encoding fields and the HDF5/netCDF4 dimension scale attributes from the attrs of a dataset.
     """
-    # file_attrs = {}
-    global_attrs = {}
-    attrs = {}
-    for i, file in enumerate(files):
-        global_attrs.update(dict(file.attrs))
-
-        # file_attrs[i] = {}
-        for name in file:
-            attr = {f: v for f, v in file[name].attrs.items() if (f not in enc_fields) and (f not in ['DIMENSION_LABELS', 'DIMENSION_LIST', 'CLASS', 'NAME', '_Netcdf4Coordinates', '_Netcdf4Dimid', 'REFERENCE_LIST'])}
-            # file_attrs[i].update({name: attr})
-
-            if name in attrs:
-                attrs[name].update(attr)
-            else:
-                attrs[name] = attr
+    attr = {f: v for f, v in attrs.items() if (f not in enc_fields) and (f not in ['DIMENSION_LABELS', 'DIMENSION_LIST', 'CLASS', 'NAME', '_Netcdf4Coordinates', '_Netcdf4Dimid', 'REFERENCE_LIST'])}
 
-    return attrs, global_attrs
+    return attr
 
 
-def is_scale(dataset):
+def xr_attrs(attrs):
     """
-
+    Prepare the attrs of a dataset or file for xarray. The attributes that the netCDF library manages itself (e.g. _NCProperties) are removed and bytes are decoded to str, so that the xr.Dataset can be saved with to_netcdf.
     """
-    check = h5py.h5ds.is_scale(dataset._id)
+    attr = {}
+    for f, v in attrs.items():
+        if f in nc_internal_attrs:
+            continue
+        if isinstance(v, bytes):
+            v = v.decode()
+        attr[f] = v
 
-    return check
+    return attr
 
 
 def is_regular_index(arr_index):
@@ -273,15 +645,66 @@ def is_regular_index(arr_index):
     return reg_bool
 
 
-def open_file(path, group=None):
+def create_file(output, **kwargs):
+    """
+    Create a new HDF5 file at a path or in a file object (overwriting it) and return it as an h5py.File opened in r+ mode with the h5py.File keyword arguments. The root group is created without its creation and modification times (which HDF5 records to the second), so that writing the same data always gives the same bytes. The keyword arguments that shape a new file (userblock_size, track_order, fs_strategy, fs_persist, fs_threshold, fs_page_size, meta_block_size, alignment_threshold, and alignment_interval) are applied when it is created.
     """
+    fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+    fapl.set_libver_bounds(h5py.h5f.LIBVER_LATEST, h5py.h5f.LIBVER_LATEST)
+
+    if kwargs.get('meta_block_size') is not None:
+        fapl.set_meta_block_size(int(kwargs['meta_block_size']))
+    if ('alignment_threshold' in kwargs) or ('alignment_interval' in kwargs):
+        fapl.set_alignment(kwargs.get('alignment_threshold', 1), kwargs.get('alignment_interval', 1))
+
+    fcpl = h5py.h5p.create(h5py.h5p.FILE_CREATE)
+    fcpl.set_obj_track_times(False)
+
+    userblock_size = kwargs.pop('userblock_size', None)
+    if userblock_size is not None:
+        fcpl.set_userblock(userblock_size)
+    if kwargs.get('track_order'):
+        fcpl.set_link_creation_order(h5py.h5p.CRT_ORDER_TRACKED | h5py.h5p.CRT_ORDER_INDEXED)
+        fcpl.set_attr_creation_order(h5py.h5p.CRT_ORDER_TRACKED | h5py.h5p.CRT_ORDER_INDEXED)
+
+    fs_strategy = kwargs.pop('fs_strategy', None)
+    fs_persist = kwargs.pop('fs_persist', False)
+    fs_threshold = kwargs.pop('fs_threshold', 1)
+    fs_page_size = kwargs.pop('fs_page_size', None)
+    if fs_strategy:
+        strategies = {'fsm': h5py.h5f.FSPACE_STRATEGY_FSM_AGGR, 'page': h5py.h5f.FSPACE_STRATEGY_PAGE, 'aggregate': h5py.h5f.FSPACE_STRATEGY_AGGR, 'none': h5py.h5f.FSPACE_STRATEGY_NONE}
+        if fs_strategy not in strategies:
+            raise ValueError('fs_strategy must be one of ' + ', '.join(strategies) + '.')
+        fcpl.set_file_space_strategy(strategies[fs_strategy], fs_persist, fs_threshold)
+        if (fs_strategy == 'page') and fs_page_size:
+            fcpl.set_file_space_page_size(int(fs_page_size))
+
+    if isinstance(output, (str, pathlib.Path)):
+        fid = h5py.h5f.create(os.fsencode(output), h5py.h5f.ACC_TRUNC, fapl=fapl, fcpl=fcpl)
+    else:
+        output.seek(0)
+        output.truncate()
+        fapl.set_fileobj_driver(h5py.h5fd.fileobj_driver, output)
+        fid = h5py.h5f.create(b'fileobj', h5py.h5f.ACC_TRUNC, fapl=fapl, fcpl=fcpl)
+    fid.close()
 
+    return h5py.File(output, 'r+', libver='latest', **kwargs)
+
+
+def open_file(path, group=None, access_profile=None):
+    """
+    Open an input as an h5py.File/Group or xr.Dataset. access_profile is an optional dict of h5py.File keyword arguments (e.g. rdcc_nbytes, rdcc_nslots, rdcc_w0, page_buf_size) used when the input has to be opened as a new h5py.File.
     """
+    if isinstance(access_profile, dict):
+        kwargs = access_profile
+    else:
+        kwargs = {}
+
     if isinstance(path, (str, pathlib.Path, io.BytesIO)):
         if isinstance(group, str):
-            f = h5py.File(path, 'r')[group]
+            f = h5py.File(path, 'r', **kwargs)[group]
         else:
-            f = h5py.File(path, 'r')
+            f = h5py.File(path, 'r', **kwargs)
     elif isinstance(path, h5py.File):
         if isinstance(group, str):
             try:
@@ -294,88 +717,545 @@ def open_file(path, group=None):
         f = path
     elif isinstance(path, bytes):
         if isinstance(group, str):
-            f = h5py.File(io.BytesIO(path), 'r')[group]
+            f = h5py.File(io.BytesIO(path), 'r', **kwargs)[group]
         else:
-            f = h5py.File(io.BytesIO(path), 'r')
+            f = h5py.File(io.BytesIO(path), 'r', **kwargs)
     else:
         raise TypeError('path must be a str/pathlib path to an HDF5 file, an h5py.File, a bytes object of an HDF5 file, or an xarray Dataset.')
 
-    return f
+    return f
+
+
+def open_files(paths, group=None, access_profile=None):
+    """
+
+    """
+    files = []
+    append = files.append
+    for path in paths:
+        f = open_file(path, group, access_profile)
+        append(f)
+
+    return files
+
+
+def close_files(files):
+    """
+
+    """
+    for f in files:
+        if isinstance(f, h5py.Group) and not isinstance(f, h5py.File):
+            f.file.close()
+        else:
+            f.close()
+        if isinstance(f, xr.Dataset):
+            del f
+            xr.backends.file_manager.FILE_CACHE.clear()
+
+
+def read_coord(ds, encoding):
+    """
+    Read the (encoded) data of a coordinate (xr.DataArray or h5py dataset). String coordinates are returned as numpy unicode arrays whatever the storage. The output never shares memory with an xr.DataArray, as the combined coordinates are made read only (see extend_coords).
+    """
+    if isinstance(ds, xr.DataArray):
+        values = ds.values
+        data = encode_data(values, **encoding)
+        if np.may_share_memory(data, values):
+            data = data.copy()
+    else:
+        if ds.dtype.name == 'object':
+            data = ds.asstr()[:]
+        else:
+            data = ds[:]
+
+        if 'codecs' in encoding:
+            data = decode_codecs(data, encoding['codecs'])
+
+    if encoding['dtype'] == h5py.string_dtype():
+        data = decode_strings(data, encoding)
+
+    return data
+
+
+def scan_file(file, read_coords=True):
+    """
+    Extract everything that is needed from an open file to combine it with other files. This includes the encodings, attrs, coordinates, and the dims of the data variables. If read_coords is False, then the coordinate data are not read and are assigned None.
+
+    Every dataset in the file is opened once and its attrs are read once. Dimension scales are identified by their CLASS attr and the dims of the data variables by their DIMENSION_LABELS attr, so the dimension scales are only dereferenced when the labels are missing or do not match the names of the coordinates.
+    """
+    is_xr = isinstance(file, xr.Dataset)
+
+    global_attrs = dict(file.attrs)
+    encodings = {}
+    attrs = {}
+    coords = {}
+    data_vars = {}
+    vars_list = []
+
+    if is_xr:
+        ds_names = list(file.variables)
+    else:
+        ds_names = list(file)
+
+    for ds_name in ds_names:
+        ds = file[ds_name]
+
+        if is_xr:
+            ds_attrs = ds.attrs
+            is_coord = ds_name in file.coords
+        else:
+            ds_attrs = dict(ds.attrs)
+            is_coord = ds_attrs.get('CLASS') == b'DIMENSION_SCALE'
+
+        encodings[ds_name] = assign_dtype_decoded(get_encoding(ds, ds_attrs))
+
+        ## xr.Datasets only iterate over their data variables (see get_attrs)
+        if not (is_xr and is_coord):
+            attrs[ds_name] = filter_attrs(ds_attrs)
+
+        if is_coord:
+            if read_coords:
+                coords[ds_name] = read_coord(ds, encodings[ds_name])
+            else:
+                coords[ds_name] = None
+        elif is_xr:
+            data_vars[ds_name] = tuple(ds.dims)
+        else:
+            vars_list.append((ds_name, ds, ds_attrs.get('DIMENSION_LABELS')))
+
+    for ds_name, ds, labels in vars_list:
+        if labels is None:
+            labels = [''] * len(ds.shape)
+        labels = tuple(label.decode() if isinstance(label, bytes) else str(label) for label in np.atleast_1d(labels))
+
+        if (len(labels) == len(ds.shape)) and all(label in coords for label in labels):
+            data_vars[ds_name] = labels
+        else:
+            data_vars[ds_name] = tuple(dim[0].name.split('/')[-1] for dim in ds.dims)
+
+    manifest = {'encodings': encodings, 'attrs': attrs, 'global_attrs': global_attrs, 'coords': coords, 'data_vars': data_vars, 'ranges': coord_ranges(coords)}
+
+    return manifest
+
+
+def coord_ranges(coords):
+    """
+    The (min, max) of the encoded data of each coordinate in a file. The range is None if the coordinate has not been read, is empty, or cannot be ordered.
+    """
+    ranges = {}
+    for ds_name, data in coords.items():
+        ranges[ds_name] = None
+        if (data is not None) and (len(data) > 0):
+            try:
+                if data.dtype.kind == 'f':
+                    ranges[ds_name] = (np.nanmin(data), np.nanmax(data))
+                else:
+                    ranges[ds_name] = (data.min(), data.max())
+            except TypeError:
+                pass
+
+    return ranges
+
+
+def prune_files(manifests, coords_dict):
+    """
+    Use the coordinate ranges of the file manifests to find the coordinates of each file that cannot overlap the (filtered) combined coords. Returns a dict of file number to a set of those coordinate names. The data variables of a file that use one of these coordinates do not need to be indexed. Coordinates without a range are always kept.
+    """
+    coords_ranges = {}
+    for k, v in coords_dict.items():
+        coords_ranges[k] = coord_ranges({k: v})[k]
+
+    pruned = {}
+    for i, manifest in enumerate(manifests):
+        coords = set()
+        for k, file_range in manifest.get('ranges', {}).items():
+            if (file_range is None) or (k not in coords_dict):
+                continue
+
+            if len(coords_dict[k]) == 0:
+                coords.add(k)
+                continue
+
+            coord_range = coords_ranges[k]
+            if coord_range is None:
+                continue
+
+            if (file_range[0] > coord_range[1]) or (file_range[1] < coord_range[0]):
+                coords.add(k)
+
+        if coords:
+            pruned[i] = coords
+
+    return pruned
+
+
+def cache_key(path, group=None):
+    """
+    The key and file stats used to store the manifest of a file in the cache. Only file paths can be cached. Returns None for other inputs.
+    """
+    if isinstance(path, (str, pathlib.Path)):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = '{path}::{group}'.format(path=path, group=group)
+
+        return key, stat.st_mtime_ns, stat.st_size
+    else:
+        return None
+
+
+def scan_path(path, group=None, read_coords=True, access_profile=None):
+    """
+    Open, scan (see scan_file), and close a single input. This is the task run by the process pool in scan_files.
+    """
+    file = open_file(path, group, access_profile)
+    manifest = scan_file(file, read_coords)
+    close_files([file])
+
+    return manifest
+
+
+def scan_files(paths, group=None, read_coords=True, cache=None, n_workers=None, access_profile=None):
+    """
+    Scan all of the input files and return a list of manifests (see scan_file). If cache is a path to a cache file, then the manifests of files with the same path, modification time, and size are read from the cache instead of the files. Newly scanned files are added to the cache (if their coordinates have been read). If n_workers > 1, then the inputs that are file paths are scanned in a pool of n_workers processes (h5py only allows one thread into the HDF5 library at a time, so threads would not help). The other inputs are scanned in the current process.
+    """
+    manifests = [None] * len(paths)
+
+    if cache is not None:
+        keys = [cache_key(path, group) for path in paths]
+
+        with shelve.open(str(cache), 'c') as db:
+            for i, key in enumerate(keys):
+                if key is not None:
+                    k, mtime, size = key
+                    if k in db:
+                        entry = db[k]
+                        if (entry['mtime'] == mtime) and (entry['size'] == size):
+                            manifests[i] = entry['manifest']
+
+    scan_index = [i for i, manifest in enumerate(manifests) if manifest is None]
+
+    if (n_workers is not None) and (n_workers > 1):
+        pool_index = [i for i in scan_index if isinstance(paths[i], (str, pathlib.Path))]
+
+        if len(pool_index) > 1:
+            chunksize = max(1, len(pool_index)//(n_workers*4))
+            with concurrent.futures.ProcessPoolExecutor(n_workers) as executor:
+                results = executor.map(scan_path, [paths[i] for i in pool_index], itertools.repeat(group), itertools.repeat(read_coords), itertools.repeat(access_profile), chunksize=chunksize)
+                for i, manifest in zip(pool_index, results):
+                    manifests[i] = manifest
+
+    new_entries = {}
+    for i in scan_index:
+        if manifests[i] is None:
+            manifests[i] = scan_path(paths[i], group, read_coords, access_profile)
+
+        if (cache is not None) and (keys[i] is not None) and read_coords:
+            k, mtime, size = keys[i]
+            new_entries[k] = {'mtime': mtime, 'size': size, 'manifest': manifests[i]}
+
+    if new_entries:
+        with shelve.open(str(cache), 'c') as db:
+            db.update(new_entries)
+
+    return manifests
+
+
+def combine_encodings(manifests, encs=None):
+    """
+    Combine the encodings of all of the file manifests. Encodings of the same named datasets in later files update the encodings of the earlier files. Existing (combined) encodings can be passed to be updated.
+    """
+    if encs is None:
+        encs = {}
+    else:
+        encs = {name: dict(enc) for name, enc in encs.items()}
+
+    for manifest in manifests:
+        for name, enc in manifest['encodings'].items():
+            if name in encs:
+                encs[name].update(enc)
+            else:
+                encs[name] = dict(enc)
+
+    for name, enc in encs.items():
+        encs[name] = assign_dtype_decoded(enc)
+
+    return encs
+
+
+def combine_attrs(manifests, attrs=None, global_attrs=None):
+    """
+    Combine the attrs and global attrs of all of the file manifests. Existing (combined) attrs and global attrs can be passed to be updated.
+    """
+    if attrs is None:
+        attrs = {}
+    else:
+        attrs = {name: dict(attr) for name, attr in attrs.items()}
+
+    if global_attrs is None:
+        global_attrs = {}
+    else:
+        global_attrs = dict(global_attrs)
+
+    for manifest in manifests:
+        global_attrs.update(manifest['global_attrs'])
+
+        for name, attr in manifest['attrs'].items():
+            if name in attrs:
+                attrs[name].update(attr)
+            else:
+                attrs[name] = dict(attr)
+
+    return attrs, global_attrs
+
+
+def extend_coords(manifests):
+    """
+    Combine the coordinates of all of the file manifests. The coordinate data of all files are concatenated and then sorted/deduplicated once (the same result as repeated np.union1d calls, but without resorting the growing union for every file). The coordinates of a single file are only sorted if they aren't already, so the combined coordinates are always sorted.
+    """
+    coords_list = {}
+
+    for manifest in manifests:
+        for ds_name, data in manifest['coords'].items():
+            if ds_name in coords_list:
+                coords_list[ds_name].append(data)
+            else:
+                coords_list[ds_name] = [data]
+
+    coords_dict = {}
+    for ds_name, data_list in coords_list.items():
+        if (len(data_list) == 1) and is_sorted(data_list[0]):
+            coords_dict[ds_name] = read_only(data_list[0])
+        else:
+            coords_dict[ds_name] = read_only(np.unique(np.concatenate(data_list)))
+
+    return coords_dict
+
+
+def index_coord(coord_data, dim_data):
+    """
+    Map the coordinate data of a file (dim_data) to the positions in the combined sorted coordinate (coord_data). Returns a tuple of the global and local indexes, which are slices if they are regular and arrays otherwise, or None if none of the file's values are in the combined coordinate. If the file's coordinate is sorted and its overlap with the combined coordinate is contiguous, then the slices are found without creating any index arrays.
+    """
+    n = len(dim_data)
+
+    if n == 0 or len(coord_data) == 0:
+        return None
+
+    if (n == 1) or np.all(dim_data[1:] > dim_data[:-1]):
+        local_start = np.searchsorted(dim_data, coord_data[0], 'left')
+        local_stop = np.searchsorted(dim_data, coord_data[-1], 'right')
+
+        if local_stop <= local_start:
+            return None
+
+        global_start = np.searchsorted(coord_data, dim_data[local_start], 'left')
+        global_stop = global_start + (local_stop - local_start)
+
+        if np.array_equal(coord_data[global_start:global_stop], dim_data[local_start:local_stop]):
+            return slice(global_start, global_stop), slice(local_start, local_stop)
+
+    pos = np.searchsorted(coord_data, dim_data)
+    pos[pos == len(coord_data)] = len(coord_data) - 1
+    local_arr_index = np.flatnonzero(coord_data[pos] == dim_data)
+
+    if len(local_arr_index) == 0:
+        return None
+
+    global_arr_index = pos[local_arr_index]
+
+    order = np.argsort(global_arr_index, kind='stable')
+    global_arr_index = global_arr_index[order]
+    local_arr_index = local_arr_index[order]
+
+    if is_regular_index(global_arr_index):
+        global_index = slice(global_arr_index[0], global_arr_index[-1] + 1)
+    else:
+        global_index = read_only(global_arr_index)
+
+    if is_regular_index(local_arr_index):
+        local_index = slice(local_arr_index[0], local_arr_index[-1] + 1)
+    else:
+        local_index = read_only(local_arr_index)
+
+    return global_index, local_index
+
+
+class IndexTable(MutableMapping):
+    """
+    A columnar table of the per-file indexes of one data variable. It behaves like a dict of file number to {'dims_order', 'global_index', 'local_index'}, but the slices are stored as start/stop arrays per dim (rows sorted by file number) so that many files take little memory and are fast to copy and pickle. Irregular (array) indexes are kept separately and their rows have start/stop values of -1. The dicts returned are built on access, so they must be replaced (not modified) to change an index.
+    """
+    def __init__(self, ndims):
+        """
+
+        """
+        self.ndims = ndims
+        self._size = 0
+        self._file_ids = np.zeros(0, dtype='int64')
+        self._dims_order = np.zeros((0, ndims), dtype='int16')
+        self._global = np.zeros((0, ndims, 2), dtype='int64')
+        self._local = np.zeros((0, ndims, 2), dtype='int64')
+        self._irregular = {}
+
+
+    def _find(self, file_id):
+        """
+        The row of a file number or None.
+        """
+        row = int(np.searchsorted(self._file_ids[:self._size], file_id))
+        if (row < self._size) and (self._file_ids[row] == file_id):
+            return row
+        else:
+            return None
+
+
+    def _insert_row(self, file_id):
+        """
+        Insert an empty row for a file number (keeping the rows sorted) and return it. The arrays are grown by doubling so that adding files in order is cheap.
+        """
+        row = int(np.searchsorted(self._file_ids[:self._size], file_id))
+
+        if self._size == len(self._file_ids):
+            capacity = max(4, 2*self._size)
+            for name in ('_file_ids', '_dims_order', '_global', '_local'):
+                old = getattr(self, name)
+                new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:self._size] = old[:self._size]
+                setattr(self, name, new)
+
+        for arr in (self._file_ids, self._dims_order, self._global, self._local):
+            arr[row + 1:self._size + 1] = arr[row:self._size]
+
+        self._file_ids[row] = file_id
+        self._size += 1
+
+        return row
+
+
+    def _clear_irregular(self, file_id):
+        """
+
+        """
+        for name in ('global_index', 'local_index'):
+            for axis in range(self.ndims):
+                self._irregular.pop((file_id, name, axis), None)
+
+
+    def __getitem__(self, file_id):
+        """
+
+        """
+        row = self._find(file_id)
+        if row is None:
+            raise KeyError(file_id)
+
+        index = {'dims_order': tuple(int(d) for d in self._dims_order[row])}
+        for name, arr in (('global_index', self._global), ('local_index', self._local)):
+            index_list = []
+            for axis in range(self.ndims):
+                start, stop = arr[row, axis]
+                if start < 0:
+                    index_list.append(self._irregular[(file_id, name, axis)])
+                else:
+                    index_list.append(slice(int(start), int(stop)))
+            index[name] = index_list
+
+        return index
+
+
+    def __setitem__(self, file_id, index):
+        """
+
+        """
+        file_id = int(file_id)
+        row = self._find(file_id)
+        if row is None:
+            row = self._insert_row(file_id)
+        else:
+            self._clear_irregular(file_id)
+
+        self._dims_order[row] = index['dims_order']
+        for name, arr in (('global_index', self._global), ('local_index', self._local)):
+            for axis, ind in enumerate(index[name]):
+                if isinstance(ind, slice) and (ind.step in (None, 1)):
+                    arr[row, axis] = (ind.start, ind.stop)
+                else:
+                    if isinstance(ind, slice):
+                        ind = np.arange(ind.start, ind.stop, ind.step)
+                    arr[row, axis] = (-1, -1)
+                    self._irregular[(file_id, name, axis)] = ind
 
 
-def open_files(paths, group=None):
-    """
+    def __delitem__(self, file_id):
+        """
 
-    """
-    files = []
-    append = files.append
-    for path in paths:
-        f = open_file(path, group)
-        append(f)
+        """
+        row = self._find(file_id)
+        if row is None:
+            raise KeyError(file_id)
 
-    return files
+        for arr in (self._file_ids, self._dims_order, self._global, self._local):
+            arr[row:self._size - 1] = arr[row + 1:self._size]
 
+        self._size -= 1
+        self._clear_irregular(file_id)
 
-def close_files(files):
-    """
 
-    """
-    for f in files:
-        f.close()
-        if isinstance(f, xr.Dataset):
-            del f
-            xr.backends.file_manager.FILE_CACHE.clear()
+    def __iter__(self):
+        """
 
+        """
+        return iter(self._file_ids[:self._size].tolist())
 
-def extend_coords(files, encodings):
-    """
 
-    """
-    coords_dict = {}
+    def __len__(self):
+        """
 
-    for file in files:
-        if isinstance(file, xr.Dataset):
-            ds_list = list(file.coords)
-        else:
-            ds_list = [ds_name for ds_name in file.keys() if is_scale(file[ds_name])]
+        """
+        return self._size
 
-        for ds_name in ds_list:
-            ds = file[ds_name]
 
-            if isinstance(file, xr.Dataset):
-                data = encode_data(ds.values, **encodings[ds_name])
-            else:
-                if ds.dtype.name == 'object':
-                    data = ds[:].astype(str).astype(h5py.string_dtype())
-                else:
-                    data = ds[:]
+    def __contains__(self, file_id):
+        """
 
-            if ds_name in coords_dict:
-                coords_dict[ds_name] = np.union1d(coords_dict[ds_name], data)
-            else:
-                coords_dict[ds_name] = data
+        """
+        return self._find(file_id) is not None
 
-    return coords_dict
 
+    def __repr__(self):
+        """
 
-def index_variables(files, coords_dict, encodings):
-    """
+        """
+        return 'IndexTable(files={size}, irregular={irr})'.format(size=self._size, irr=len(self._irregular))
 
-    """
-    vars_dict = {}
 
-    for i, file in enumerate(files):
-        # if i == 77:
-        #     break
+    def copy(self):
+        """
+        Copy the table. The irregular index arrays are shared (they are read only).
+        """
+        c = IndexTable(self.ndims)
+        c._size = self._size
+        c._file_ids = self._file_ids[:self._size].copy()
+        c._dims_order = self._dims_order[:self._size].copy()
+        c._global = self._global[:self._size].copy()
+        c._local = self._local[:self._size].copy()
+        c._irregular = dict(self._irregular)
 
-        if isinstance(file, xr.Dataset):
-            ds_list = list(file.data_vars)
-        else:
-            ds_list = [ds_name for ds_name in file.keys() if not is_scale(file[ds_name])]
+        return c
+
+
+def index_variables(manifests, coords_dict, encodings, vars_dict=None, start=0, pruned=None):
+    """
+    Index the data variables of the file manifests against the combined coords. Existing indexed variables can be passed as vars_dict to add the new files to. start is the file number of the first manifest. pruned is an optional dict of file number to the coordinates that are known not to overlap the combined coords (see prune_files). The coordinate mapping of each file is only computed once and is shared by all of the variables in the file.
+    """
+    if vars_dict is None:
+        vars_dict = {}
 
-        for ds_name in ds_list:
-            ds = file[ds_name]
+    if pruned is None:
+        pruned = {}
 
+    for i, manifest in enumerate(manifests, start):
+        dims_index = {dim_name: None for dim_name in pruned.get(i, ())}
+
+        for ds_name, ds_dims in manifest['data_vars'].items():
             var_enc = encodings[ds_name]
 
             dims = []
@@ -383,38 +1263,15 @@ def index_variables(files, coords_dict, encodings):
             local_index = []
             remove_ds = False
 
-            for dim in ds.dims:
-                if isinstance(file, xr.Dataset):
-                    dim_name = dim
-                    dim_data = encode_data(ds[dim_name].values, **encodings[dim_name])
-                else:
-                    dim_name = dim[0].name.split('/')[-1]
-                    if dim[0].dtype.name == 'object':
-                        dim_data = dim[0][:].astype(str).astype(h5py.string_dtype())
-                    else:
-                        dim_data = dim[0][:]
+            for dim_name in ds_dims:
+                if dim_name not in dims_index:
+                    dims_index[dim_name] = index_coord(coords_dict[dim_name], manifest['coords'][dim_name])
 
                 dims.append(dim_name)
 
-                # if dim_name == 'lon':
-                #     break
-
-                global_arr_index = np.where(np.isin(coords_dict[dim_name], dim_data))[0]
-                local_arr_index = np.where(np.isin(dim_data, coords_dict[dim_name]))[0]
-
-                if len(global_arr_index) > 0:
-
-                    if is_regular_index(global_arr_index):
-                        slice1 = slice(global_arr_index.min(), global_arr_index.max() + 1)
-                        global_index.append(slice1)
-                    else:
-                        global_index.append(global_arr_index)
-
-                    if is_regular_index(local_arr_index):
-                        slice1 = slice(local_arr_index.min(), local_arr_index.max() + 1)
-                        local_index.append(slice1)
-                    else:
-                        local_index.append(local_arr_index)
+                if dims_index[dim_name] is not None:
+                    global_index.append(dims_index[dim_name][0])
+                    local_index.append(dims_index[dim_name][1])
                 else:
                     remove_ds = True
                     break
@@ -447,11 +1304,127 @@ def index_variables(files, coords_dict, encodings):
                     else:
                         fillvalue = None
 
-                    vars_dict[ds_name] = {'data': {i: dict1}, 'dims': tuple(dims), 'shape': shape, 'dtype': var_enc['dtype'], 'fillvalue': fillvalue, 'dtype_decoded': var_enc['dtype_decoded']}
+                    data = IndexTable(len(dims))
+                    data[i] = dict1
+
+                    vars_dict[ds_name] = {'data': data, 'dims': tuple(dims), 'shape': shape, 'dtype': var_enc['dtype'], 'fillvalue': fillvalue, 'dtype_decoded': var_enc['dtype_decoded']}
 
     return vars_dict
 
 
+def remap_index(index, pos_map):
+    """
+    Remap a global index (slice or array) to new positions. pos_map is an array of the new positions of every old position.
+    """
+    arr_index = pos_map[index]
+
+    if is_regular_index(arr_index):
+        return slice(arr_index.min(), arr_index.max() + 1)
+    else:
+        return read_only(arr_index)
+
+
+def remap_var_index(var_dict, axis, pos_map):
+    """
+    Remap the global indexes of one axis of an indexed variable (see remap_index). The per-file indexes are replaced rather than modified, so they can be shared with copies of the variable.
+    """
+    for i, index in list(var_dict['data'].items()):
+        global_index = list(index['global_index'])
+        global_index[axis] = remap_index(global_index[axis], pos_map)
+        var_dict['data'][i] = dict(index, global_index=global_index)
+
+
+def read_only(data):
+    """
+    Make an array read only (in place) so that it can be safely shared between H5 instances. Returns the array.
+    """
+    data.flags.writeable = False
+
+    return data
+
+
+def copy_vars_dict(vars_dict):
+    """
+    Copy the containers of the indexed variables that can be modified (the variable dicts and their IndexTables). The irregular index arrays are shared as they are never modified in place.
+    """
+    return {var_name: dict(var, data=var['data'].copy()) for var_name, var in vars_dict.items()}
+
+
+def plan_append_coord(ds, data):
+    """
+    Check that (encoded) coordinate data can be merged into an existing coordinate h5py dataset without changing it (see append_coord). New values must come after the existing values and the dataset must be resizable (i.e. an unlimited dim). Returns a dict of the encoding of the dataset, the number of existing values, the merged data, and the positions of the data in the merged data.
+    """
+    encoding = get_encoding(ds)
+    old_data = read_coord(ds, encoding)
+
+    new_data = np.union1d(old_data, data)
+
+    if len(new_data) > len(old_data):
+        if not np.array_equal(new_data[:len(old_data)], old_data):
+            raise ValueError('New values of the coordinate ' + ds.name + ' would need to be inserted between the existing values. Only appending values after the existing values is supported.')
+        if ds.maxshape[0] is not None:
+            raise ValueError('The coordinate ' + ds.name + ' has new values, but it is not an unlimited dimension.')
+
+    pos_map = np.searchsorted(new_data, data)
+
+    return {'encoding': encoding, 'n_old': len(old_data), 'data': new_data, 'pos_map': pos_map}
+
+
+def append_coord(ds, plan):
+    """
+    Merge coordinate data into an existing coordinate h5py dataset with a plan from plan_append_coord. The codecs and string storage of the existing dataset are applied to the merged data. Returns the positions of the data in the updated dataset.
+    """
+    encoding = plan['encoding']
+    n_old = plan['n_old']
+    new_data = plan['data']
+
+    if len(new_data) > n_old:
+        ds.resize(new_data.shape)
+        if 'categories' in encoding:
+            encoding['categories'] = np.union1d(encoding['categories'], new_data).tolist()
+            ds[:] = encode_strings(new_data, encoding, ds.dtype)
+            ds.attrs['categories'] = json.dumps(encoding['categories'])
+        elif encoding['dtype'] == h5py.string_dtype():
+            ds[n_old:] = encode_strings(new_data[n_old:], encoding, ds.dtype)
+        elif 'codecs' in encoding:
+            ds[:] = encode_codecs(new_data, encoding['codecs'])
+        else:
+            ds[n_old:] = new_data[n_old:]
+
+    return plan['pos_map']
+
+
+def extend_index(coords_dict, vars_dict, manifests, encodings, start):
+    """
+    Add new file manifests to existing combined coords and indexed variables (in place). Only the new files are indexed. If the new coordinate values all come after the existing values, then the existing indexes are unchanged. Otherwise the global indexes of the existing files are remapped to the new coordinate positions (without rereading the files).
+    """
+    new_coords = extend_coords(manifests)
+
+    for coord, new_data in new_coords.items():
+        if coord in coords_dict:
+            old_data = coords_dict[coord]
+            data = np.union1d(old_data, new_data)
+
+            if len(data) > len(old_data):
+                if not np.array_equal(data[:len(old_data)], old_data):
+                    pos_map = np.searchsorted(data, old_data)
+
+                    for var_name, var in vars_dict.items():
+                        if coord in var['dims']:
+                            remap_var_index(var, var['dims'].index(coord), pos_map)
+
+                coords_dict[coord] = read_only(data)
+        else:
+            coords_dict[coord] = new_data
+
+    for var in vars_dict.values():
+        var['shape'] = tuple(coords_dict[dim].shape[0] for dim in var['dims'])
+
+    index_variables(manifests, coords_dict, encodings, vars_dict, start)
+
+    return coords_dict, vars_dict
+
+
 # def index_coords_file(file, coords_dict, encodings, selection: dict):
 #     """
 
@@ -513,34 +1486,148 @@ def index_variables(files, coords_dict, encodings):
 #     return index_coords_dict
 
 
-def filter_coords(files, coords_dict, selection, encodings):
+def is_sorted(data):
+    """
+    Check if a 1D array is sorted in ascending order (arrays with NaNs are not).
+    """
+    if len(data) < 2:
+        return True
+    else:
+        return bool(np.all(data[:-1] <= data[1:]))
+
+
+def is_order_preserving(encoding):
+    """
+    Check if the decoded values of a coordinate have the same order as the encoded values, so that a sorted encoded coordinate is also sorted when decoded.
+    """
+    scale_factor = encoding.get('scale_factor')
+    if isinstance(scale_factor, (int, float, np.number)):
+        if (scale_factor <= 0) or ('missing_value' in encoding):
+            return False
+
+    return True
+
+
+def search_sorted_coord(coord_data, value, encoding):
+    """
+    Binary search of a decoded value in a sorted encoded coordinate. Only the coordinate values that are probed are decoded, so the bounds never need to be encoded (which could round them). Returns the position of the first value that is >= value (like np.searchsorted with side='left').
+    """
+    low = 0
+    high = len(coord_data)
+    while low < high:
+        mid = (low + high)//2
+        if decode_data(coord_data[mid:mid+1], **encoding)[0] < value:
+            low = mid + 1
+        else:
+            high = mid
+
+    return low
+
+
+def slice_sorted_coord(coord_data, sel, encoding):
+    """
+    Resolve a slice selection (start <= x < stop) on a sorted encoded coordinate to a slice of positions.
+    """
+    is_datetime = 'datetime64' in encoding['dtype_decoded'].name
+
+    bounds = []
+    for value, default in ((sel.start, 0), (sel.stop, len(coord_data))):
+        if value is None:
+            bounds.append(default)
+        else:
+            if is_datetime:
+                value = np.datetime64(value, 's')
+            bounds.append(search_sorted_coord(coord_data, value, encoding))
+
+    return slice(bounds[0], max(bounds))
+
+
+def slice_mask(coord_data, sel):
+    """
+    The boolean mask of a slice selection (start <= x < stop) on a decoded coordinate. Datetime bounds can be anything that np.datetime64 accepts.
+    """
+    is_datetime = 'datetime64' in coord_data.dtype.name
+
+    bool_index = np.ones(coord_data.shape, dtype=bool)
+    if sel.start is not None:
+        start = np.datetime64(sel.start, 's') if is_datetime else sel.start
+        bool_index &= start <= coord_data
+    if sel.stop is not None:
+        stop = np.datetime64(sel.stop, 's') if is_datetime else sel.stop
+        bool_index &= coord_data < stop
+
+    return bool_index
+
+
+def nearest_index(coord_data, values, tolerance=None):
+    """
+    The positions in a decoded coordinate of the nearest coordinate value to each of the values (ties go to the lower value). Values without a coordinate value within the tolerance are dropped. Datetimes are compared in seconds and the tolerance can be a np.timedelta64 or a number of seconds. Returns the sorted unique positions.
     """
+    if 'datetime64' in coord_data.dtype.name:
+        coord_data = coord_data.astype('datetime64[s]').astype('int64')
+        values = values.astype('datetime64[s]').astype('int64')
+        if isinstance(tolerance, np.timedelta64):
+            tolerance = tolerance / np.timedelta64(1, 's')
+
+    n = len(coord_data)
+    if (n == 0) or (len(values) == 0):
+        return np.array([], dtype='int64')
+
+    if is_sorted(coord_data):
+        sorter = None
+        sorted_data = coord_data
+    else:
+        sorter = np.argsort(coord_data, kind='stable')
+        sorted_data = coord_data[sorter]
+
+    right = np.searchsorted(sorted_data, values).clip(0, n - 1)
+    left = (right - 1).clip(0, n - 1)
+    use_left = np.abs(values - sorted_data[left]) <= np.abs(sorted_data[right] - values)
+    positions = np.where(use_left, left, right)
 
+    if tolerance is not None:
+        positions = positions[np.abs(sorted_data[positions] - values) <= tolerance]
+
+    if sorter is not None:
+        positions = sorter[positions]
+
+    return np.unique(positions)
+
+
+def filter_coords(coords_dict, selection, encodings, method=None, tolerance=None):
     """
+    Filter the coords_dict in place by the selection. Slice selections (or lists of slices) are resolved with binary searches on the sorted coordinates (see extend_coords) without decoding the whole coordinate. If method is 'nearest', then selections of values select the nearest coordinate values within the tolerance instead of exact matches.
+    """
+    if method not in (None, 'nearest'):
+        raise ValueError("method must be either None or 'nearest'.")
+
     for coord, sel in selection.items():
         if coord not in coords_dict:
             raise ValueError(coord + ' one of the coordinates.')
 
-        coord_data = decode_data(coords_dict[coord], **encodings[coord])
+        encoding = encodings[coord]
+        coord_data = coords_dict[coord]
 
         if isinstance(sel, slice):
-            if 'datetime64' in coord_data.dtype.name:
-                # if not isinstance(sel.start, (str, np.datetime64)):
-                #     raise TypeError('Input for datetime selection should be either a datetime string or np.datetime64.')
-
-                if sel.start is not None:
-                    start = np.datetime64(sel.start, 's')
-                else:
-                    start = np.datetime64(coord_data[0] - 1, 's')
+            slices = [sel]
+        elif isinstance(sel, (list, tuple)) and (len(sel) > 0) and all(isinstance(s, slice) for s in sel):
+            slices = list(sel)
+        else:
+            slices = None
 
-                if sel.stop is not None:
-                    end = np.datetime64(sel.stop, 's')
+        if slices is not None:
+            if all(s.step is None for s in slices) and is_order_preserving(encoding):
+                index_list = [slice_sorted_coord(coord_data, s, encoding) for s in slices]
+                if len(index_list) == 1:
+                    coords_dict[coord] = coord_data[index_list[0]]
                 else:
-                    end = np.datetime64(coord_data[-1] + 1, 's')
+                    coords_dict[coord] = read_only(coord_data[np.unique(np.concatenate([np.arange(s.start, s.stop) for s in index_list]))])
+                continue
 
-                bool_index = (start <= coord_data) & (coord_data < end)
-            else:
-                bool_index = (sel.start <= coord_data) & (coord_data < sel.stop)
+            coord_data_decoded = decode_data(coord_data, **encoding)
+            bool_index = np.zeros(coord_data.shape, dtype=bool)
+            for s in slices:
+                bool_index |= slice_mask(coord_data_decoded, s)
 
         else:
             if isinstance(sel, (int, float)):
@@ -555,12 +1642,12 @@ def filter_coords(files, coords_dict, selection, encodings):
                 if sel1.shape[0] != coord_data.shape[0]:
                     raise ValueError('The boolean array does not have the same length as the coord array.')
                 bool_index = sel1
+            elif method == 'nearest':
+                bool_index = nearest_index(decode_data(coord_data, **encoding), np.atleast_1d(sel1), tolerance)
             else:
-                bool_index = np.in1d(coord_data, sel1)
+                bool_index = np.in1d(decode_data(coord_data, **encoding), sel1)
 
-        new_coord_data = encode_data(coord_data[bool_index], **encodings[coord])
-
-        coords_dict[coord] = new_coord_data
+        coords_dict[coord] = read_only(coord_data[bool_index])
 
 
 
@@ -642,12 +1729,42 @@ def filter_coords(files, coords_dict, selection, encodings):
 #     return sel_dict1
 
 
-def guess_chunk(shape, maxshape, dtype):
+def chunk_weights(dims, strategy, time_dims=('time',)):
+    """
+    The per axis weights of a chunk strategy for guess_chunk. 'timeseries' keeps the time dims whole for as long as possible (for reading long time series of few stations), 'spatial' keeps the other dims whole for as long as possible (for reading few time steps of all stations), and 'balanced' gives all dims the same weight. A dict of dim names with weights (missing dims get 1) can also be passed. Returns None (the default round robin chunking) for None or an int (which is a target chunk size in bytes rather than a strategy and must be positive).
+    """
+    if isinstance(strategy, (bool, np.bool_)):
+        raise ValueError('The chunk strategy must not be a bool.')
+    elif isinstance(strategy, (int, np.integer)):
+        if strategy <= 0:
+            raise ValueError('The target chunk size must be a positive int (in bytes).')
+        return None
+    elif strategy is None:
+        return None
+    elif strategy == 'balanced':
+        return [1] * len(dims)
+    elif strategy == 'timeseries':
+        return [np.inf if dim in time_dims else 1 for dim in dims]
+    elif strategy == 'spatial':
+        return [0 if dim in time_dims else 1 for dim in dims]
+    elif isinstance(strategy, dict):
+        return [strategy.get(dim, 1) for dim in dims]
+    else:
+        raise ValueError("The chunk strategy must be one of 'timeseries', 'spatial', 'balanced', a dict of dims with weights, an int of the target chunk size in bytes, or None.")
+
+
+def guess_chunk(shape, maxshape, dtype, weights=None, target_size=None):
     """ Guess an appropriate chunk layout for a dataset, given its shape and
     the size of each element in bytes.  Will allocate chunks only as large
     as MAX_SIZE.  Chunks are generally close to some power-of-2 fraction of
     each axis, slightly favoring bigger values for the last index.
     Undocumented and subject to change without warning.
+
+    If weights are passed (see chunk_weights), then the axis with the largest
+    chunk length per weight is halved each time instead of going round robin,
+    so the chunk lengths end up roughly proportional to the weights. A weight
+    of 0 is always halved first and inf is only halved last. target_size is
+    the chunk size in bytes to aim for (CHUNK_MAX by default).
     """
 
     if len(shape) > 0:
@@ -684,7 +1801,12 @@ def guess_chunk(shape, maxshape, dtype):
         # elif target_size < CHUNK_MIN:
         #     target_size = CHUNK_MIN
 
-        target_size = CHUNK_MAX
+        if target_size is None:
+            target_size = CHUNK_MAX
+        chunk_max = max(CHUNK_MAX, target_size)
+
+        if weights is not None:
+            weights = np.array(weights, dtype='=f8')
 
         idx = 0
         while True:
@@ -697,265 +1819,672 @@ def guess_chunk(shape, maxshape, dtype):
 
             if (chunk_bytes < target_size or \
              abs(chunk_bytes-target_size)/target_size < 0.5) and \
-             chunk_bytes < CHUNK_MAX:
+             chunk_bytes < chunk_max:
                 break
 
             if np.product(chunks) == 1:
                 break  # Element size larger than CHUNK_MAX
 
-            chunks[idx%ndims] = np.ceil(chunks[idx%ndims] / 2.0)
-            idx += 1
+            if weights is None:
+                axis = idx%ndims
+                idx += 1
+            else:
+                with np.errstate(divide='ignore'):
+                    ratios = np.where(chunks > 1, chunks / weights, -1)
+                axis = int(np.argmax(ratios))
+
+            chunks[axis] = np.ceil(chunks[axis] / 2.0)
 
         return tuple(int(x) for x in chunks)
     else:
         return None
 
 
-def index_chunks(shape, chunks, global_index, local_index, dims_order, factor=3):
+def index_axis_blocks(g_index, l_index, chunk_size):
     """
-
+    Split the global and local index (slices or arrays) of one axis into blocks that are contiguous in both the global and local index and that don't cross the global chunk_size boundaries. Returns four arrays of the global starts, global stops, local starts, and local stops of the blocks. Slices are split arithmetically without creating index arrays.
     """
-    local_shapes = []
-    global_shapes = []
+    if isinstance(g_index, slice) and isinstance(l_index, slice):
+        g_start = int(g_index.start)
+        g_stop = int(g_index.stop)
 
-    for i, s in enumerate(chunks):
-        chunk_size = s*factor
+        first = ((g_start // chunk_size) + 1) * chunk_size
+        bounds = np.arange(first, g_stop, chunk_size, dtype='int64')
 
-        g_slices, l_slices = array_index_to_slices(global_index[i], local_index[i], chunk_size)
+        g_starts = np.concatenate(([g_start], bounds))
+        g_stops = np.concatenate((bounds, [g_stop]))
 
-        global_shapes.append(g_slices)
-        local_shapes.append(l_slices)
+        l_starts = g_starts - g_start + int(l_index.start)
+        l_stops = g_stops - g_start + int(l_index.start)
 
-    try:
-        global_cart = cartesian(global_shapes)
-        local_cart = cartesian(local_shapes)
-    except:
-        global_cart = np.array(np.meshgrid(global_shapes)).T.reshape(-1, len(shape))
-        local_cart = np.array(np.meshgrid(local_shapes)).T.reshape(-1, len(shape))
-
-    global_slices = [tuple(g) for g in global_cart]
-
-    # local_order = tuple(dims_order.index(i) for i in range(len(dims_order)))
-    local_slices = []
-    append = local_slices.append
-    for l in local_cart:
-        append(tuple(l[i] for i in dims_order))
-
-    return global_slices, local_slices
-
-
-def cartesian(arrays, out=None):
-    """
-    Generate a cartesian product of input arrays.
-
-    Parameters
-    ----------
-    arrays : list of array-like
-        1-D arrays to form the cartesian product of.
-    out : ndarray
-        Array to place the cartesian product in.
-
-    Returns
-    -------
-    out : ndarray
-        2-D array of shape (M, len(arrays)) containing cartesian products
-        formed of input arrays.
-
-    Examples
-    --------
-    >>> cartesian(([1, 2, 3], [4, 5], [6, 7]))
-    array([[1, 4, 6],
-            [1, 4, 7],
-            [1, 5, 6],
-            [1, 5, 7],
-            [2, 4, 6],
-            [2, 4, 7],
-            [2, 5, 6],
-            [2, 5, 7],
-            [3, 4, 6],
-            [3, 4, 7],
-            [3, 5, 6],
-            [3, 5, 7]])
-
-    """
-
-    arrays = [np.asarray(x) for x in arrays]
-    dtype = arrays[0].dtype
-
-    n = np.prod([x.size for x in arrays])
-    if out is None:
-        out = np.zeros([n, len(arrays)], dtype=dtype)
-
-    m = int(n / arrays[0].size)
-    out[:,0] = np.repeat(arrays[0], m)
-    if arrays[1:]:
-        cartesian(arrays[1:], out=out[0:m, 1:])
-        for j in range(1, arrays[0].size):
-            out[j*m:(j+1)*m, 1:] = out[0:m, 1:]
+    else:
+        if isinstance(g_index, slice):
+            g_arr = np.arange(g_index.start, g_index.stop, dtype='int64')
+        else:
+            g_arr = np.asarray(g_index, dtype='int64')
 
-    return out
+        if isinstance(l_index, slice):
+            l_arr = np.arange(l_index.start, l_index.stop, dtype='int64')
+        else:
+            l_arr = np.asarray(l_index, dtype='int64')
 
+        breaks = np.flatnonzero((np.diff(g_arr) != 1) | (np.diff(l_arr) != 1) | (np.diff(g_arr // chunk_size) != 0)) + 1
 
-def get_compressor(name: str = None):
-    """
+        start_pos = np.concatenate(([0], breaks))
+        stop_pos = np.concatenate((breaks, [len(g_arr)])) - 1
+
+        g_starts = g_arr[start_pos]
+        g_stops = g_arr[stop_pos] + 1
+        l_starts = l_arr[start_pos]
+        l_stops = l_arr[stop_pos] + 1
 
+    return g_starts, g_stops, l_starts, l_stops
+
+
+class ChunkPlan(object):
     """
-    if name is None:
-        compressor = {}
-    elif name == 'gzip':
-        compressor = {'compression': name}
-    elif name == 'lzf':
-        compressor = {'compression': name}
-    elif name == 'zstd':
-        compressor = hdf5plugin.Zstd(1)
-    else:
-        raise ValueError('name must be one of gzip, lzf, zstd, or None.')
+    The plan of the blocks needed to copy the data of one input dataset into the output dataset. Only the block boundaries per axis are stored (memory is proportional to the sum of the number of blocks per axis) and the (global_chunk, local_chunk) tuples of slices are generated lazily on iteration. The local chunks are in the dims order of the input dataset.
+    """
+    def __init__(self, chunks, global_index, local_index, dims_order, factor=3):
+        """
+
+        """
+        self.dims_order = dims_order
+        self.axes = [index_axis_blocks(g, l, c*factor) for g, l, c in zip(global_index, local_index, chunks)]
+
+
+    def __len__(self):
+        """
+
+        """
+        return int(np.prod([len(axis[0]) for axis in self.axes]))
+
+
+    def __iter__(self):
+        """
+
+        """
+        global_axes = []
+        local_axes = []
+        for g_starts, g_stops, l_starts, l_stops in self.axes:
+            global_axes.append([slice(int(start), int(stop)) for start, stop in zip(g_starts, g_stops)])
+            local_axes.append([slice(int(start), int(stop)) for start, stop in zip(l_starts, l_stops)])
+
+        dims_order = self.dims_order
+
+        for pos in itertools.product(*[range(len(axis)) for axis in global_axes]):
+            global_chunk = tuple(global_axes[i][p] for i, p in enumerate(pos))
+            local_chunk = tuple(local_axes[i][pos[i]] for i in dims_order)
+
+            yield global_chunk, local_chunk
 
-    return compressor
 
+    def block_shape(self):
+        """
+        The largest block length per axis (in the global dims order).
+        """
+        return tuple(int((g_stops - g_starts).max()) if len(g_starts) else 0 for g_starts, g_stops, l_starts, l_stops in self.axes)
 
-def array_index_to_slices(g_arr, l_arr, chunk_size):
+
+def next_prime(n):
+    """
+    The smallest prime number >= n.
     """
+    n = max(2, int(n))
+    while any(n % d == 0 for d in range(2, int(n**0.5) + 1)):
+        n += 1
+
+    return n
+
 
+def chunk_cache_kwargs(chunks, itemsize, block_shape, w0=1):
     """
-    # if isinstance(g_arr, slice) and isinstance(l_arr, slice):
-    #     return [g_arr], [l_arr]
+    The chunk cache settings (h5py rdcc_nbytes, rdcc_nslots, and rdcc_w0) of a dataset that is read or written in blocks of block_shape. The cache holds all of the chunks that a block can overlap (limited to CHUNK_CACHE_MAX) so that no chunk is decompressed (or compressed) more than once per block. The number of hash slots is a prime about 100 times the number of chunks that fit in the cache as recommended by the HDF5 docs (limited to about 100000). w0=1 evicts fully read/written chunks first.
+    """
+    n_chunks = 1
+    for c, b in zip(chunks, block_shape):
+        n_chunks *= int(np.ceil(max(b - 1, 0)/c)) + 1
 
-    if isinstance(l_arr, slice):
-        l_start = l_arr.start
-        l_stop = l_arr.stop
-        l_arr = np.arange(l_start, l_stop)
-    # else:
-    #     l_start = l_arr.min()
-    #     l_stop = l_arr.max()
-        # reg1 = np.append(np.diff(l_arr) != 1, True)
+    chunk_nbytes = int(np.prod(chunks)) * itemsize
+    nbytes = min(max(n_chunks * chunk_nbytes, 1024*1024), CHUNK_CACHE_MAX)
+    nslots = next_prime(min(100 * max(n_chunks, nbytes // chunk_nbytes), 100000))
 
-    if isinstance(g_arr, slice):
-        g_start = g_arr.start
-        g_stop = g_arr.stop
-        g_arr = np.arange(g_start, g_stop)
-    else:
-        g_start = g_arr.min()
-        g_stop = g_arr.max()
+    return {'rdcc_nbytes': nbytes, 'rdcc_nslots': nslots, 'rdcc_w0': w0}
 
-    reg1 = np.append(np.diff(g_arr) != 1, True)
 
-    chunk_start = (g_start//chunk_size) * chunk_size
-    chunk_stop = ((g_stop // chunk_size) + 1) * chunk_size
+def open_dataset(group, name, rdcc_nbytes, rdcc_nslots, rdcc_w0):
+    """
+    Open an existing h5py dataset with its own chunk cache settings (instead of the settings of its file). HDF5 only applies the settings when the dataset is not already open, so any other h5py objects of the dataset should be released first.
+    """
+    dapl = h5py.h5p.create(h5py.h5p.DATASET_ACCESS)
+    dapl.set_chunk_cache(rdcc_nslots, rdcc_nbytes, rdcc_w0)
+
+    return h5py.Dataset(h5py.h5d.open(group.id, name.encode(), dapl=dapl))
 
-    chunk_stops = np.arange(chunk_start, chunk_stop, chunk_size) - 1
-    chunk_stop_pos = np.in1d(g_arr, chunk_stops)
 
-    reg2 = reg1 + chunk_stop_pos
+def index_chunks(shape, chunks, global_index, local_index, dims_order, factor=3):
+    """
+    Create the ChunkPlan of the blocks needed to copy an input dataset into the output dataset. The blocks are up to factor times the chunk size per axis.
+    """
+    return ChunkPlan(chunks, global_index, local_index, dims_order, factor)
 
-    stop_pos = np.where(reg2)[0]
 
-    g_reg_list = []
-    l_reg_list = []
-    for i, pos in enumerate(stop_pos):
-        if i == 0:
-            g_start = g_arr[0]
-            l_start = l_arr[0]
-        else:
-            g_start = g_arr[stop_pos[i-1]+1]
-            l_start = l_arr[stop_pos[i-1]+1]
-        g_stop = g_arr[pos]+1
-        l_stop = l_arr[pos]+1
-        g_reg_list.append(slice(g_start, g_stop))
-        l_reg_list.append(slice(l_start, l_stop))
+def index_var_chunks(files, var_name, var_dict, chunks, ds_new=None, factor=3, access_profile=None):
+    """
+    Generator of all of the blocks needed to assemble a data variable from the input files. Yields tuples of (global_chunk, input dataset, local_chunk, transpose_order, direct). The blocks are up to factor times the chunks per axis. If the new h5py dataset is passed and an input dataset has the same chunking, filters, and dtype, then the blocks are the size of a single chunk and direct is True so that the chunks can be copied without decompressing them. If access_profile is 'auto', then the chunked h5py input datasets that are read block by block are reopened with a chunk cache sized from the chunk plan (see chunk_cache_kwargs).
+    """
+    shape = var_dict['shape']
 
-    return g_reg_list, l_reg_list
+    for i, index in var_dict['data'].items():
+        ds_old = files[i][var_name]
 
+        dims_order = index['dims_order']
+        transpose_order = tuple(dims_order.index(d) for d in range(len(dims_order)))
 
+        if ds_new is None:
+            direct = False
+        else:
+            direct = is_direct_chunk_compatible(ds_old, ds_new, index)
 
+        if direct:
+            chunk_plan = index_chunks(shape, chunks, index['global_index'], index['local_index'], dims_order, factor=1)
+        else:
+            chunk_plan = index_chunks(shape, chunks, index['global_index'], index['local_index'], dims_order, factor)
 
+            if (access_profile == 'auto') and isinstance(ds_old, h5py.Dataset) and (ds_old.chunks is not None):
+                block_shape = chunk_plan.block_shape()
+                local_block_shape = tuple(block_shape[d] for d in dims_order)
+                cache_kwargs = chunk_cache_kwargs(ds_old.chunks, ds_old.dtype.itemsize, local_block_shape)
+                parent = ds_old.parent
+                del ds_old
+                ds_old = open_dataset(parent, var_name, **cache_kwargs)
 
+        for global_chunk, local_chunk in chunk_plan:
+            yield global_chunk, ds_old, local_chunk, transpose_order, direct
 
 
+def is_direct_chunk_compatible(ds_old, ds_new, index):
+    """
+    Check whether the raw (compressed) chunks of an input dataset can be copied straight into the new dataset. The chunk shape, filters, dtype (not variable length), fillvalue, and dims order must be the same and the chunk boundaries of the input must line up with the chunk boundaries of the output.
+    """
+    if not isinstance(ds_old, h5py.Dataset):
+        return False
 
+    if (ds_old.chunks is None) or (ds_old.chunks != ds_new.chunks):
+        return False
 
+    if (ds_old.dtype != ds_new.dtype) or (ds_old._filters != ds_new._filters):
+        return False
 
+    # Variable length data (e.g. strings) are stored as references to the heap of the input file
+    if ds_old.dtype.hasobject:
+        return False
 
+    if ds_old.fillvalue != ds_new.fillvalue:
+        return False
 
+    # The raw chunks include the codecs of the input
+    if ds_old.attrs.get('codecs') != ds_new.attrs.get('codecs'):
+        return False
 
+    if index['dims_order'] != tuple(range(len(index['dims_order']))):
+        return False
 
+    for g, l, c in zip(index['global_index'], index['local_index'], ds_new.chunks):
+        if not (isinstance(g, slice) and isinstance(l, slice)):
+            return False
+        if (g.start - l.start) % c != 0:
+            return False
 
+    return True
 
 
+def read_direct_chunk(ds_old, global_chunk, local_chunk, chunks, shape):
+    """
+    Read a raw (compressed) chunk from an input dataset if the block covers exactly one chunk in both the input and the new dataset (with chunks and shape). Partial chunks at the edges are only used when they are at the edges of both datasets. Returns a tuple of (filter_mask, chunk bytes) or None if the block must be read normally.
+    """
+    for g, l, c, old_s, new_s in zip(global_chunk, local_chunk, chunks, ds_old.shape, shape):
+        if (g.start % c != 0) or (l.start % c != 0):
+            return None
+        if (l.stop - l.start) != c:
+            if (l.stop != old_s) or (g.stop != new_s):
+                return None
 
+    try:
+        raw_chunk = ds_old.id.read_direct_chunk(tuple(l.start for l in local_chunk))
+    except RuntimeError:
+        # The chunk has not been allocated in the input
+        return None
 
+    return raw_chunk
 
 
+def read_chunk(ds_old, local_chunk, transpose_order, encoding, decode=False):
+    """
+    Read a block of data from an input dataset (h5py.Dataset or xr.DataArray). The output is encoded and in the dims order of the output dataset. If decode is True, then the output is decoded instead (see float_encoding).
+    """
+    if isinstance(ds_old, xr.DataArray):
+        data = ds_old[local_chunk].copy().load()
+        values = data.values
+        data.close()
+        del data
 
+        if transpose_order != tuple(range(len(transpose_order))):
+            values = values.transpose(transpose_order)
 
+        if decode:
+            output = values.astype(encoding['dtype_decoded'], copy=False)
+        else:
+            output = encode_data(values, **encoding)
+    else:
+        string_info = h5py.check_string_dtype(ds_old.dtype)
+        if string_info is not None:
+            output = ds_old.asstr()[local_chunk]
+        else:
+            output = ds_old[local_chunk]
 
+        if 'codecs' in encoding:
+            output = decode_codecs(output, encoding['codecs'])
 
+        if decode:
+            output = decode_data(output, **encoding)
 
+        if transpose_order != tuple(range(len(transpose_order))):
+            output = output.transpose(transpose_order)
 
+    return output
 
 
+def index_intersect(g_index, l_index, req_index):
+    """
+    Find which of the requested global positions (req_index, an array) of one axis are covered by the global index of an input file. Returns the positions in the request and the matching local positions in the input file.
+    """
+    if isinstance(g_index, slice):
+        req_pos = np.flatnonzero((req_index >= g_index.start) & (req_index < g_index.stop))
+        rel_pos = req_index[req_pos] - g_index.start
+    else:
+        pos = np.searchsorted(g_index, req_index)
+        pos[pos == len(g_index)] = len(g_index) - 1
+        req_pos = np.flatnonzero(g_index[pos] == req_index)
+        rel_pos = pos[req_pos]
 
+    if isinstance(l_index, slice):
+        local_pos = rel_pos + l_index.start
+    else:
+        local_pos = l_index[rel_pos]
 
+    return req_pos, local_pos
 
 
+class LazyArray(xr.backends.BackendArray):
+    """
+    A lazy (xarray backend) array of a combined data variable. Only the parts of the input files that are requested are read and decoded.
+    """
+    def __init__(self, paths, group, var_name, var_dict, encoding, access_profile=None):
+        """
+
+        """
+        self.paths = paths
+        self.group = group
+        self.access_profile = access_profile
+        self.var_name = var_name
+        self.var_dict = var_dict
+        self.encoding = encoding
+        self.shape = var_dict['shape']
+
+        if 'datetime64' in encoding['dtype_decoded'].name:
+            self.dtype = np.dtype('datetime64[ns]')
+        else:
+            self.dtype = encoding['dtype_decoded']
 
 
+    def __getitem__(self, key):
+        """
 
+        """
+        return xr.core.indexing.explicit_indexing_adapter(key, self.shape, xr.core.indexing.IndexingSupport.BASIC, self._getitem)
 
 
+    def _getitem(self, key):
+        """
 
+        """
+        req_index = []
+        int_axes = []
+        for axis, k in enumerate(key):
+            if isinstance(k, (int, np.integer)):
+                k = slice(k, k + 1)
+                int_axes.append(axis)
+            req_index.append(np.arange(*k.indices(self.shape[axis])))
 
+        out_shape = tuple(len(r) for r in req_index)
 
+        fillvalue = self.var_dict['fillvalue']
+        if fillvalue is None:
+            out = np.zeros(out_shape, dtype=self.dtype)
+        else:
+            fill = decode_data(np.array([fillvalue], dtype=self.var_dict['dtype']), **self.encoding)
+            out = np.full(out_shape, fill[0], dtype=self.dtype)
+
+        for i, index in self.var_dict['data'].items():
+            req_pos_list = []
+            local_pos_list = []
+            for g, l, r in zip(index['global_index'], index['local_index'], req_index):
+                req_pos, local_pos = index_intersect(g, l, r)
+                if len(req_pos) == 0:
+                    break
+                req_pos_list.append(req_pos)
+                local_pos_list.append(local_pos)
 
+            if len(req_pos_list) < len(req_index):
+                continue
 
+            dims_order = index['dims_order']
+            transpose_order = tuple(dims_order.index(d) for d in range(len(dims_order)))
 
+            ## Read the bounding box of the local positions and then subselect
+            local_chunk = tuple(slice(local_pos_list[d].min(), local_pos_list[d].max() + 1) for d in dims_order)
 
+            file = open_file(self.paths[i], self.group, self.access_profile)
+            data = read_chunk(file[self.var_name], local_chunk, transpose_order, self.encoding)
+            if not isinstance(file, xr.Dataset):
+                close_files([file])
 
+            sub_index = tuple(local_pos - local_pos.min() for local_pos in local_pos_list)
+            data = decode_data(data[np.ix_(*sub_index)], **self.encoding)
 
+            out[np.ix_(*req_pos_list)] = data
 
+        if int_axes:
+            out = out.squeeze(axis=tuple(int_axes))
 
+        return out
 
 
+def read_lazy_block(lazy_arr, key):
+    """
+    Read a block of a LazyArray with a tuple of slices. Used as the task function of the dask graph.
+    """
+    return lazy_arr._getitem(key)
 
 
+def to_dask_array(lazy_arr, chunks):
+    """
+    Build a dask array from a LazyArray. Each block of the dask array is a separate task that reads and decodes the intersecting parts of the input files, so the blocks can be read in parallel by the dask workers.
+    """
+    try:
+        import dask.array as da
+        from dask.base import tokenize
+    except ImportError:
+        raise ImportError('dask must be installed to return dask arrays.')
+
+    ## Block sizes and slices per dim
+    dims_chunks = []
+    dims_slices = []
+    for size, chunk in zip(lazy_arr.shape, chunks):
+        if size == 0:
+            dims_chunks.append((0,))
+            dims_slices.append([slice(0, 0)])
+            continue
+        chunk = max(1, min(chunk, size))
+        starts = range(0, size, chunk)
+        dims_chunks.append(tuple(min(chunk, size - start) for start in starts))
+        dims_slices.append([slice(start, min(start + chunk, size)) for start in starts])
+
+    name = 'hdf5tools-' + lazy_arr.var_name + '-' + tokenize(lazy_arr.paths, lazy_arr.group, lazy_arr.var_name, lazy_arr.var_dict, chunks)
+    arr_name = 'original-' + name
+
+    dsk = {arr_name: lazy_arr}
+    for block_id, key in zip(itertools.product(*[range(len(c)) for c in dims_chunks]), itertools.product(*dims_slices)):
+        dsk[(name,) + block_id] = (read_lazy_block, arr_name, key)
+
+    return da.Array(dsk, name, chunks=tuple(dims_chunks), dtype=lazy_arr.dtype)
+
+
+def imap_ordered(func, iterable, n_workers=None, executor=None):
+    """
+    Like map, but runs func in a pool of n_workers threads (or in an existing executor, e.g. a process pool). The results are yielded in the same order as the iterable and at most 2*n_workers tasks are in flight at any time so that memory stays bounded. If n_workers is None or 1 (and no executor is passed), then func is run in the calling thread.
+    """
+    if executor is not None:
+        futures = deque()
+        for args in iterable:
+            futures.append(executor.submit(func, *args))
+            if len(futures) >= n_workers*2:
+                yield futures.popleft().result()
+
+        while futures:
+            yield futures.popleft().result()
+
+    elif (n_workers is None) or (n_workers <= 1):
+        for args in iterable:
+            yield func(*args)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(n_workers) as executor:
+            yield from imap_ordered(func, iterable, n_workers, executor)
 
 
+def index_output_blocks(var_dict, chunks, factor=3):
+    """
+    Generator of the blocks of the output dataset that contain data. The blocks are aligned to the chunks and are up to factor times the chunks per axis. Yields tuples of (block, file ids) in the order of the block positions, where block is a tuple of slices and file ids are the input files whose global index spans the block. Only the first and last block of every file per axis are stored (like ChunkPlan, nothing is kept per block) and the files of the blocks are filtered axis by axis.
+    """
+    shape = var_dict['shape']
+    block_size = [c*factor for c in chunks]
+
+    file_ids = []
+    ranges = []
+    for i, index in var_dict['data'].items():
+        file_range = []
+        for g, b in zip(index['global_index'], block_size):
+            if isinstance(g, slice):
+                file_range.append((g.start // b, (g.stop - 1) // b) if g.stop > g.start else (1, 0))
+            elif len(g):
+                file_range.append((int(np.min(g)) // b, int(np.max(g)) // b))
+            else:
+                file_range.append((1, 0))
+        file_ids.append(i)
+        ranges.append(file_range)
 
+    if not file_ids:
+        return
 
+    file_ids = np.asarray(file_ids)
+    ranges = np.asarray(ranges, dtype='int64').reshape(len(file_ids), len(shape), 2)
 
+    def iter_axis(axis, rows):
+        first = ranges[rows, axis, 0]
+        last = ranges[rows, axis, 1]
+        b = block_size[axis]
 
+        for p in range(int(first.min()), int(last.max()) + 1):
+            rows1 = rows[(first <= p) & (last >= p)]
+            if len(rows1) == 0:
+                continue
 
+            s = slice(p*b, min((p + 1)*b, shape[axis]))
+            if axis == len(shape) - 1:
+                yield (s,), rows1
+            else:
+                for block, rows2 in iter_axis(axis + 1, rows1):
+                    yield (s,) + block, rows2
 
+    for block, rows in iter_axis(0, np.arange(len(file_ids))):
+        yield block, file_ids[rows].tolist()
 
 
+def encode_block(files, var_name, indexes, var_info, encoding, codecs, block, chunks, compressor, direct_ids=(), access_profile=None, decode=False):
+    """
+    Assemble one output block (see index_output_blocks) from the input files, encode it, and compress the chunks that contain data with the filters of the output dataset. indexes are the file indexes (of the data variable) of the files that intersect the block, var_info is a dict of the shape, dtype, and fillvalue of the output dataset, and codecs are the codecs of the output. If decode is True, then the data are decoded with the input encoding before the codecs (for float data that are stored as floats, see float_encoding). The chunks of the files in direct_ids (see is_direct_chunk_compatible) that are not shared with other files are copied raw.
 
+    The chunks are compressed by writing them to a temporary in-memory HDF5 dataset with the same chunks, dtype, fillvalue, and filters as the output and reading them back raw, so they are exactly what HDF5 would have written to the output. Returns a list of tuples of (chunk offset, filter_mask, chunk bytes) for the output's write_direct_chunk.
+    """
+    dtype = np.dtype(var_info['dtype'])
+    fillvalue = var_info['fillvalue']
+
+    req_index = [np.arange(b.start, b.stop) for b in block]
+    n_chunks = tuple(int(np.ceil(len(r)/c)) for r, c in zip(req_index, chunks))
+
+    ## The positions of each file in the block and the chunks they touch
+    file_pos = {}
+    counts = np.zeros(n_chunks, dtype='int32')
+    for i, index in indexes.items():
+        req_pos_list = []
+        local_pos_list = []
+        for g, l, r in zip(index['global_index'], index['local_index'], req_index):
+            req_pos, local_pos = index_intersect(g, l, r)
+            if len(req_pos) == 0:
+                break
+            req_pos_list.append(req_pos)
+            local_pos_list.append(local_pos)
+
+        if len(req_pos_list) < len(req_index):
+            continue
+
+        chunk_ids = [np.unique(req_pos // c) for req_pos, c in zip(req_pos_list, chunks)]
+        counts[np.ix_(*chunk_ids)] += 1
+        file_pos[i] = (req_pos_list, local_pos_list, chunk_ids)
+
+    ## Copy the raw chunks of compatible inputs
+    raw_chunks = {}
+    for i in list(file_pos):
+        if i not in direct_ids:
+            continue
+
+        req_pos_list, local_pos_list, chunk_ids = file_pos[i]
+        ds_old = files[i][var_name]
+        all_raw = True
+        for pos in itertools.product(*chunk_ids):
+            raw_chunk = None
+            if counts[pos] == 1:
+                global_chunk = []
+                local_chunk = []
+                for p, b, c, req_pos, local_pos in zip(pos, block, chunks, req_pos_list, local_pos_list):
+                    chunk_pos = np.flatnonzero(req_pos // c == p)
+                    start = int(req_pos[chunk_pos[0]])
+                    stop = int(req_pos[chunk_pos[-1]]) + 1
+                    l_start = int(local_pos[chunk_pos[0]])
+                    global_chunk.append(slice(b.start + start, b.start + stop))
+                    local_chunk.append(slice(l_start, l_start + stop - start))
+                raw_chunk = read_direct_chunk(ds_old, global_chunk, local_chunk, chunks, var_info['shape'])
+
+            if raw_chunk is None:
+                all_raw = False
+            else:
+                raw_chunks[pos] = raw_chunk
 
+        if all_raw:
+            del file_pos[i]
 
+    ## Read, encode, and place the data of the other files
+    padded = tuple(n*c for n, c in zip(n_chunks, chunks))
+    if fillvalue is None:
+        out = np.zeros(padded, dtype=dtype)
+    else:
+        out = np.full(padded, fillvalue, dtype=dtype)
 
+    for i, (req_pos_list, local_pos_list, chunk_ids) in file_pos.items():
+        dims_order = indexes[i]['dims_order']
+        transpose_order = tuple(dims_order.index(d) for d in range(len(dims_order)))
 
+        ## Read the bounding box of the local positions and then subselect
+        local_chunk = tuple(slice(int(local_pos_list[d].min()), int(local_pos_list[d].max()) + 1) for d in dims_order)
 
+        ds_old = files[i][var_name]
+        if (access_profile == 'auto') and isinstance(ds_old, h5py.Dataset) and (ds_old.chunks is not None):
+            cache_kwargs = chunk_cache_kwargs(ds_old.chunks, ds_old.dtype.itemsize, tuple(l.stop - l.start for l in local_chunk))
+            parent = ds_old.parent
+            del ds_old
+            ds_old = open_dataset(parent, var_name, **cache_kwargs)
 
+        data = read_chunk(ds_old, local_chunk, transpose_order, encoding, decode)
 
+        # Contiguous positions (the usual case) are sliced rather than fancy indexed, which copies
+        sub_index = [local_pos - local_pos.min() for local_pos in local_pos_list]
+        if all(is_regular_index(p) for p in req_pos_list + sub_index):
+            data = data[tuple(slice(p[0], p[-1] + 1) for p in sub_index)]
+            out[tuple(slice(p[0], p[-1] + 1) for p in req_pos_list)] = encode_codecs(data, codecs)
+        else:
+            out[np.ix_(*req_pos_list)] = encode_codecs(data[np.ix_(*sub_index)], codecs)
 
+    ## Compress the chunks
+    output = []
+    with h5py.File(io.BytesIO(), 'w', rdcc_nbytes=0) as tmp:
+        ds_tmp = tmp.create_dataset('data', padded, chunks=tuple(chunks), dtype=dtype, fillvalue=fillvalue, **compressor)
 
+        for pos in zip(*np.nonzero(counts)):
+            offset = tuple(b.start + p*c for p, b, c in zip(pos, block, chunks))
+            if pos in raw_chunks:
+                filter_mask, chunk = raw_chunks[pos]
+            else:
+                tmp_offset = tuple(p*c for p, c in zip(pos, chunks))
+                ds_tmp[tuple(slice(o, o + c) for o, c in zip(tmp_offset, chunks))] = out[tuple(slice(o, o + c) for o, c in zip(tmp_offset, chunks))]
+                filter_mask, chunk = ds_tmp.id.read_direct_chunk(tmp_offset)
 
+            output.append((offset, filter_mask, chunk))
 
+    return output
 
 
+block_worker = {}
 
 
+def init_block_worker(paths, group, access_profile):
+    """
+    Initializer of the processes that run encode_block_worker. The input files are opened when they are first needed.
+    """
+    block_worker.clear()
+    block_worker.update({'paths': paths, 'group': group, 'access_profile': access_profile, 'files': {}})
 
 
+class BlockWorkerFiles(object):
+    """
+    The input files of a block worker process by position in the paths.
+    """
+    def __getitem__(self, i):
+        """
 
+        """
+        files = block_worker['files']
+        if i not in files:
+            files[i] = open_file(block_worker['paths'][i], block_worker['group'], block_worker['access_profile'])
 
+        return files[i]
 
 
+def encode_block_worker(*args):
+    """
+    Run encode_block in a process of a pool that was started with init_block_worker.
+    """
+    return encode_block(BlockWorkerFiles(), *args)
 
 
+def block_executor(paths, group, files, n_workers=None, access_profile=None):
+    """
+    The executor and function that run encode_block for to_hdf5. If all of the inputs are paths, then the blocks are encoded in a pool of n_workers processes (so that the HDF5 library lock doesn't serialise the reading, decoding, and compression). Otherwise the open files are shared by a pool of n_workers threads. If n_workers is None or 1, then the executor is None and the blocks are encoded in the calling thread. Returns a tuple of (executor, function).
+    """
+    if (n_workers is None) or (n_workers <= 1):
+        return None, functools.partial(encode_block, files)
 
+    if all(isinstance(path, (str, pathlib.Path)) for path in paths):
+        executor = concurrent.futures.ProcessPoolExecutor(n_workers, initializer=init_block_worker, initargs=([str(path) for path in paths], group, access_profile))
 
+        return executor, encode_block_worker
 
+    return concurrent.futures.ThreadPoolExecutor(n_workers), functools.partial(encode_block, files)
 
 
+def get_compressor(name: str = None):
+    """
 
+    """
+    if name is None:
+        compressor = {}
+    elif name == 'gzip':
+        compressor = {'compression': name}
+    elif name == 'lzf':
+        compressor = {'compression': name}
+    elif name == 'zstd':
+        compressor = hdf5plugin.Zstd(1)
+    else:
+        raise ValueError('name must be one of gzip, lzf, zstd, or None.')
 
+    return compressor